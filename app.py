@@ -1,26 +1,41 @@
 # app.py
-from flask import Flask, render_template, jsonify, request, send_from_directory
+from flask import Flask, Response, render_template, jsonify, request, send_from_directory
 import subprocess
 import threading
 import os
-import json
+import gzip
 import time
-import signal
 import logging
 
 import config
 import state
-from camera_handler import record_video, take_snapshot
-from youtube_uploader import retry_failed_uploads
+import store
+from encoding import governor
+from bluetooth import presence
+from preview import mjpeg_stream
+from postprocess import take_title
+import devices
+import upload_queue
+import storage
+import audio_meter
+import events
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = config.STATIC_MAX_AGE_SECONDS  # Static files also carry an ETag
 
-def is_phone_connected():
-    try:
-        output = subprocess.check_output("hcitool con", shell=True).decode()
-        return "ACL" in output
-    except Exception:
-        return False
+# Held by each open /events or /preview.mjpg response, see config.MAX_STREAMS
+_stream_slots = threading.BoundedSemaphore(config.MAX_STREAMS)
+
+def _stream_response(stream, **kwargs):
+    """A Response for a long-lived stream, or a 503 when config.MAX_STREAMS are already open."""
+    if not _stream_slots.acquire(blocking=False):
+        response = jsonify({"status": "busy", "message": "Too many open streams, try again shortly."})
+        response.status_code = 503
+        response.headers["Retry-After"] = "10"
+        return response
+    response = Response(stream, **kwargs)
+    response.call_on_close(_stream_slots.release)
+    return response
 
 def update_active_color():
     """
@@ -28,32 +43,40 @@ def update_active_color():
     If it's different, the active color is moved to the next in the list
     and the date is updated.
     """
-    today_str = time.strftime("%Y-%m-%d")
-
-    if not os.path.exists(config.COLORS_PATH):
-        default_colors = {
-            "last_updated": "2000-01-01",
-            "active_index": 0,
-            "colors": ["#A7C7E7", "#C1E1C1", "#FDFD96", "#FFB347", "#FF6961"]
-        }
-        with open(config.COLORS_PATH, 'w') as f:
-            json.dump(default_colors, f, indent=2)
-
-    with open(config.COLORS_PATH, 'r+') as f:
-        data = json.load(f)
-        stored_date_str = data.get("last_updated")
-
-        if stored_date_str != today_str:
-            print(f"Date changed. Rotating active color.")
-            current_index = data.get("active_index", 0)
-            num_colors = len(data.get("colors", []))
-            # Rotate to the next color, loop to the start if at the end
-            data["active_index"] = (current_index + 1) % num_colors
-            data["last_updated"] = today_str
-            # Go back to the start of the file and overwrite
-            f.seek(0)
-            json.dump(data, f, indent=2)
-            f.truncate()
+    if store.roll_color_over():
+        print(f"Date changed. Rotating active color.")
+
+def _color_rollover_loop():
+    """Rolls the color of the day over just after every midnight, also when the server runs for days."""
+    while True:
+        now = time.localtime()
+        midnight = time.mktime((now.tm_year, now.tm_mon, now.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        time.sleep(max(1, midnight - time.time() + 1))
+        try:
+            update_active_color()
+        except Exception as e:
+            print(f"Color rollover failed: {e}")
+
+@app.after_request
+def compress_json(response):
+    """
+    Gzips JSON responses for clients that accept it, then answers conditional
+    requests, so a client whose copy is current gets an empty 304. The ETag of a
+    gzipped body gets its own suffix, since it is a different representation.
+    """
+    if response.mimetype != "application/json" or response.status_code != 200 or response.is_streamed:
+        return response
+    response.vary.add("Accept-Encoding")
+    if ("gzip" in request.headers.get("Accept-Encoding", "")
+            and response.content_length and response.content_length >= config.GZIP_MIN_BYTES):
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(etag + "-gz", weak)
+    if response.get_etag()[0]:
+        response.make_conditional(request)
+    return response
 
 @app.route("/")
 def index():
@@ -61,49 +84,64 @@ def index():
 
 @app.route("/songs")
 def songs():
-    with open(config.SONGS_PATH) as f:
-        songs = json.load(f)
-    songs.sort(key=lambda s: s["number"])
-
-    # Standardize the data before sending it to the client
-    # This makes the frontend code simpler and more robust.
-    processed_songs = []
-    for song in songs:
-        processed_songs.append({
-            "number": song["number"],
-            "title": song["name"], # Use "name" as the source for "title"
-            "filename": f"{song['number']:02d}-{song['name'].replace(' ', '_')}.txt", # Create a filename
-            "active": song.get("active", False) # Send the active status
-        })
-    return jsonify(processed_songs)
+    # Standardized for the client once per change of songs.json, see store.py
+    songs = store.songs.get()
+    response = jsonify(songs["listing"])
+    response.set_etag(songs["etag"])
+    response.cache_control.no_cache = True  # Always revalidated, usually with a 304
+    return response
 
 @app.route("/start", methods=["POST"])
 def start():
-    if state.RECORDING:
-        return jsonify({"status": "already recording"})
     data = request.get_json()
+    cameras = data.get("cameras") # Camera names; all cameras when missing
+    try:
+        selected = devices.select(cameras)
+    except KeyError as e:
+        return jsonify({"status": "unknown camera", "message": f"No camera named {e}"}), 400
+    idle = [device for device in selected if not device.busy()]
+    if not idle:
+        return jsonify({"status": "already recording"})
+    allowed, warning = storage.admit_take(len(idle))
+    if not allowed:
+        return jsonify({"status": "insufficient space", "message": warning}), 507
     filename = data.get("filename")
-    title = data.get("title", filename) # Use filename as a fallback
-    state.CURRENT_SONG = title
-    t = threading.Thread(target=record_video, args=(title,))
-    t.start()
-    return jsonify({"status": "started"})
+    set_mode = bool(data.get("set", False))
+    # A set is titled after the whole run-through; its songs are titled from the setlist
+    title = data.get("title", filename) or ("Set" if set_mode else None) # Use filename as a fallback
+    started = devices.start(title, cameras, set_mode)
+    if not started:
+        return jsonify({"status": "already recording"})
+    return jsonify({"status": "started", "cameras": started, "warning": warning})
 
 @app.route("/stop", methods=["POST"])
 def stop():
-    if state.RECORD_PROC and state.RECORDING:
-        # Use os.killpg to send the signal to the entire process group.
-        # This is a more robust way to terminate the process.
-        os.killpg(os.getpgid(state.RECORD_PROC.pid), signal.SIGINT)
-        return jsonify({"status": "stopped"})
+    data = request.get_json(silent=True) or {}
+    try:
+        stopped = devices.stop(data.get("cameras"))
+    except KeyError as e:
+        return jsonify({"status": "unknown camera", "message": f"No camera named {e}"}), 400
+    if stopped:
+        return jsonify({"status": "stopped", "cameras": stopped})
     return jsonify({"status": "not recording"})
 
+def _status():
+    cameras = {name: device.status() for name, device in devices.registry().items()}
+    default = cameras[devices.default().name]
+    return {
+        "recording": state.RECORDING,
+        "bluetooth": presence.connected,
+        "bluetooth_checked_at": presence.checked_at,
+        "cameras": cameras,
+        "recorder": default["recorder"],
+        "last_take_write": default["last_take_write"],
+        "last_take_encoding": governor.last_report,
+        "disk": storage.disk_status()
+    }
+
 @app.route("/status")
 def status():
-    return jsonify({
-        "recording": state.RECORDING,
-        "bluetooth": is_phone_connected()
-    })
+    return jsonify(_status())
 
 @app.route("/upload_errors")
 def upload_errors():
@@ -117,17 +155,37 @@ def clear_error():
     error_index = data.get("index")
     if error_index is not None and 0 <= error_index < len(state.UPLOAD_ERRORS):
         state.UPLOAD_ERRORS.pop(error_index)
+        events.errors_changed()
     return jsonify({"status": "ok"})
 
+def _upload_statuses():
+    statuses = []
+    # Add the active recordings to the top of the list
+    for device in devices.registry().values():
+        song = device.current_song
+        if device.recording and song:
+            statuses.append({'title': take_title(song, device.angle), 'status': 'Recording...'})
+    for video_path, upload in list(state.UPLOAD_STATUS.items()):
+        statuses.append(events.upload_entry(video_path, upload))
+    return statuses
+
 @app.route("/upload_status")
 def get_upload_status():
     """Returns a list of ongoing uploads and the active recording."""
-    statuses = []
-    # Add the active recording to the top of the list if it exists
-    if state.RECORDING and state.CURRENT_SONG:
-        statuses.append({'title': state.CURRENT_SONG, 'status': 'Recording...'})
-    statuses.extend(list(state.UPLOAD_STATUS.values()))
-    return jsonify(statuses)
+    return jsonify(_upload_statuses())
+
+@app.route("/events")
+def event_stream():
+    """
+    Server-Sent Events with recording, upload and error changes, so the UI can
+    keep one idle connection open instead of polling. A new connection starts
+    with a 'snapshot' event; a reconnect with Last-Event-ID gets what it missed.
+    """
+    def snapshot():
+        return {"status": _status(), "uploads": _upload_statuses(), "errors": list(state.UPLOAD_ERRORS)}
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("lastEventId")
+    return _stream_response(events.hub.stream(last_event_id, snapshot), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/static/<path:path>")
 def static_files(path):
@@ -157,17 +215,50 @@ def shutdown():
 
 @app.route("/snapshot.jpg")
 def snapshot():
+    """Snapshot of the camera named by ?camera=, the default camera without it."""
     try:
-        snapshot_path = take_snapshot()
-        return send_from_directory(os.path.dirname(snapshot_path), os.path.basename(snapshot_path))
+        device = devices.get(request.args.get("camera"))
+        sequence, jpeg = device.snapshot()
     except Exception:
         return ("", 404)
+    response = Response(jpeg, mimetype="image/jpeg")
+    # Conditional on the snapshot sequence, so an unchanged snapshot is answered with a 304.
+    response.set_etag(device.snapshot_etag(sequence))
+    response.cache_control.public = True
+    response.cache_control.max_age = config.SNAPSHOT_MAX_AGE_SECONDS
+    return response.make_conditional(request)
+
+@app.route("/audio_levels")
+def audio_levels():
+    """
+    Microphone levels per channel (peak and RMS in dBFS) and clipped samples,
+    for setting the gain before a take. Pass ?after=<sequence> to wait for the
+    next reading instead of polling.
+    """
+    if not config.AUDIO_ENABLED or audio_meter.np is None:
+        return jsonify({"active": False, "message": "Audio metering needs AUDIO_ENABLED and numpy."}), 503
+    after = request.args.get("after", type=int)
+    return jsonify(audio_meter.meter().levels(after_sequence=after))
+
+@app.route("/preview.mjpg")
+def preview_mjpg():
+    """Live preview of the camera named by ?camera= as a multipart MJPEG stream, shared by all viewers."""
+    try:
+        device = devices.get(request.args.get("camera"))
+    except KeyError:
+        return ("", 404)
+    return _stream_response(mjpeg_stream(device), mimetype="multipart/x-mixed-replace; boundary=frame")
 
 # --- Application Startup ---
 # This code runs once when Gunicorn starts the worker process.
 print("Application starting: Running one-time setup...")
 update_active_color()
-retry_failed_uploads() # Starts the periodic check for failed uploads
+os.makedirs(config.RECORDINGS_DIR, exist_ok=True) # /status measures free space there before the first take
+threading.Thread(target=_color_rollover_loop, name="color-rollover", daemon=True).start()
+for device in devices.registry().values():
+    device.service() # Warms up the camera services when CAMERA_BACKEND is "picamera2"
+upload_queue.start_workers() # Resumes queued uploads and starts the upload workers
+presence.start() # Tracks the phone's Bluetooth connection for /status
 
 if __name__ == "__main__":
     os.makedirs("static", exist_ok=True)
@@ -0,0 +1,93 @@
+# audio_analysis.py
+import subprocess
+
+import config
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ANALYSIS_SAMPLE_RATE = 8000  # Plenty for energy analysis, and cheap to decode
+
+def pcm_blocks(path, block_seconds):
+    """
+    Decodes the audio track of a file to mono 16-bit PCM and yields it in blocks
+    of block_seconds as int16 arrays, so a long take is never held in memory.
+    """
+    block_bytes = int(ANALYSIS_SAMPLE_RATE * block_seconds) * 2
+    proc = subprocess.Popen(
+        ["nice", "-n", "19", "ffmpeg", "-nostdin", "-loglevel", "error", "-i", path,
+         "-vn", "-ac", "1", "-ar", str(ANALYSIS_SAMPLE_RATE), "-f", "s16le", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            data = proc.stdout.read(block_bytes)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % 2], dtype=np.int16)
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+def window_levels_db(path, window_seconds=None):
+    """
+    Returns the RMS level in dBFS of every window_seconds window of a file's audio,
+    computed block by block. An empty array means the file has no audio track.
+    """
+    window_seconds = window_seconds or config.AUDIO_WINDOW_SECONDS
+    window = int(ANALYSIS_SAMPLE_RATE * window_seconds)
+    # Whole windows per block, so no window spans two blocks
+    block_seconds = window_seconds * max(1, int(60 / window_seconds))
+    levels = []
+    leftover = np.empty(0, dtype=np.int16)
+    for block in pcm_blocks(path, block_seconds):
+        samples = np.concatenate((leftover, block)) if leftover.size else block
+        whole = samples.size - samples.size % window
+        if whole:
+            windows = samples[:whole].astype(np.float32).reshape(-1, window) / 32768.0
+            rms = np.sqrt((windows * windows).mean(axis=1))
+            levels.append(20 * np.log10(np.maximum(rms, 1e-6)))
+        leftover = samples[whole:]
+    return np.concatenate(levels) if levels else np.empty(0, dtype=np.float32)
+
+def music_mask(levels):
+    """
+    Marks windows that belong to music: the level, smoothed over
+    config.AUDIO_SUSTAIN_SECONDS, is within config.AUDIO_MUSIC_BELOW_PEAK_DB of
+    the take's loud passages (95th percentile). Short noises such as a tuning
+    note or a cough don't last long enough to count.
+    """
+    reference = np.percentile(levels, 95)
+    sustain = max(1, int(config.AUDIO_SUSTAIN_SECONDS / config.AUDIO_WINDOW_SECONDS))
+    # Pad with the edge levels; zero padding would read as 0 dBFS, i.e. loud
+    padded = np.pad(levels, (sustain // 2, sustain - 1 - sustain // 2), mode="edge")
+    smoothed = np.convolve(padded, np.ones(sustain) / sustain, mode="valid")
+    return smoothed > reference - config.AUDIO_MUSIC_BELOW_PEAK_DB
+
+def music_segments(levels, count=None):
+    """
+    Splits a recording into songs: returns (start, end) times in seconds of runs
+    of music, bridging quiet passages shorter than config.SET_MIN_GAP_SECONDS and
+    dropping runs shorter than config.SET_MIN_SONG_SECONDS. If more segments are
+    found than count, the two closest together are merged until count remain.
+    """
+    window = config.AUDIO_WINDOW_SECONDS
+    mask = music_mask(levels)
+    # Starts and ends of runs of music, in windows
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    segments = []
+    for start, end in zip(edges[::2] * window, edges[1::2] * window):
+        if segments and start - segments[-1][1] < config.SET_MIN_GAP_SECONDS:
+            segments[-1][1] = end
+        else:
+            segments.append([start, end])
+    segments = [s for s in segments if s[1] - s[0] >= config.SET_MIN_SONG_SECONDS]
+
+    while count is not None and len(segments) > max(count, 1):
+        gaps = [segments[i + 1][0] - segments[i][1] for i in range(len(segments) - 1)]
+        i = gaps.index(min(gaps))
+        segments[i][1] = segments.pop(i + 1)[1]
+    return [(float(start), float(end)) for start, end in segments]
@@ -0,0 +1,156 @@
+# audio_meter.py
+import time
+import subprocess
+import threading
+
+import config
+import state
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_CLIP_LEVEL = 32767 - 8  # Samples this close to full scale count as clipped
+
+def _db(value):
+    return round(20 * float(np.log10(max(value, 1e-6))), 1)
+
+def measure(block, channels):
+    """Peak and RMS level (dBFS) and clipped sample count per channel of a block of int16 PCM."""
+    samples = block[:block.size - block.size % channels].reshape(-1, channels).astype(np.int32)
+    magnitude = np.abs(samples)
+    peak = magnitude.max(axis=0) / 32768.0
+    scaled = samples.astype(np.float32) / 32768.0
+    rms = np.sqrt((scaled * scaled).mean(axis=0))
+    clipped = (magnitude >= _CLIP_LEVEL).sum(axis=0)
+    return [_db(p) for p in peak], [_db(r) for r in rms], [int(c) for c in clipped]
+
+class AudioMeter:
+    """
+    Audio capture stage for the level meter. Runs one arecord reading fixed blocks
+    of PCM while the meter has been polled in the last config.AUDIO_METER_IDLE_SECONDS,
+    and publishes peak/RMS/clip counts per block. rpicam-vid needs the sound card
+    for itself while recording, so the meter pauses during a take unless
+    config.AUDIO_DEVICE is a shared (dsnoop) device.
+    """
+
+    def __init__(self):
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self._levels = None
+        self._clipped_total = 0
+        self._last_clip_at = None
+        self._last_polled = 0.0
+        self._lock = threading.Lock()
+        self._proc = None
+        self._thread = None
+
+    def poll(self):
+        """Marks the meter as wanted; starts capturing if it isn't yet."""
+        with self._lock:
+            self._last_polled = time.monotonic()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="audio-meter", daemon=True)
+                self._thread.start()
+
+    def reset_clips(self):
+        """Clears the clip counter; called when a take starts so it reports clipping for that take."""
+        with self.condition:
+            self._clipped_total = 0
+            self._last_clip_at = None
+
+    def clipped_total(self):
+        with self.condition:
+            return self._clipped_total
+
+    def levels(self, after_sequence=None, timeout=2.0):
+        """
+        The latest levels as a small dict for the UI. With after_sequence, waits up
+        to timeout for a newer block, so clients can long-poll instead of hammering.
+        """
+        self.poll()
+        with self.condition:
+            if after_sequence is not None:
+                self.condition.wait_for(lambda: self.sequence > after_sequence, timeout=timeout)
+            since_clip = None if self._last_clip_at is None else round(time.monotonic() - self._last_clip_at, 1)
+            return dict(self._levels or {}, **{
+                "sequence": self.sequence,
+                "active": self.is_active(),
+                "clipped_total": self._clipped_total,
+                "seconds_since_clip": since_clip,
+            })
+
+    def is_active(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def _wanted(self):
+        idle = time.monotonic() - self._last_polled > config.AUDIO_METER_IDLE_SECONDS
+        shared = config.AUDIO_DEVICE.startswith("dsnoop")
+        return not idle and (shared or not state.RECORDING or config.CAMERA_BACKEND != "rpicam")
+
+    def release_device(self):
+        """Stops capturing so rpicam-vid can open the sound card; called before a take starts."""
+        if not self._wanted():
+            self._stop_process()
+
+    def _stop_process(self):
+        with self._lock:
+            proc, self._proc = self._proc, None
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+
+    def _start_process(self):
+        cmd = [
+            "arecord", "-q", "-D", config.AUDIO_DEVICE, "-f", "S16_LE", "-t", "raw",
+            "-c", str(config.AUDIO_CHANNELS), "-r", str(config.AUDIO_SAMPLE_RATE)
+        ]
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def _run(self):
+        channels = config.AUDIO_CHANNELS
+        block_bytes = int(config.AUDIO_SAMPLE_RATE * config.AUDIO_METER_BLOCK_SECONDS) * channels * 2
+        while True:
+            with self._lock:
+                wanted = self._wanted()
+                proc = self._proc
+                if wanted and proc is None:
+                    try:
+                        proc = self._proc = self._start_process()
+                    except OSError as e:
+                        print(f"Could not start the audio meter: {e}")
+            if wanted and proc is None:
+                time.sleep(5.0)
+                continue
+            if not wanted:
+                if proc is not None:
+                    self._stop_process()
+                time.sleep(0.2)
+                continue
+
+            data = proc.stdout.read(block_bytes) if proc.poll() is None else b""
+            if len(data) < block_bytes:
+                # Device busy or unplugged; try again when wanted.
+                with self._lock:
+                    if self._proc is proc:
+                        self._proc = None
+                if proc.poll() is None:
+                    proc.terminate()
+                proc.wait()
+                time.sleep(1.0)
+                continue
+
+            peak, rms, clipped = measure(np.frombuffer(data, dtype=np.int16), channels)
+            with self.condition:
+                self._levels = {"peak_db": peak, "rms_db": rms, "clipped": sum(clipped)}
+                if sum(clipped):
+                    self._clipped_total += sum(clipped)
+                    self._last_clip_at = time.monotonic()
+                self.sequence += 1
+                self.condition.notify_all()
+
+_meter = AudioMeter()
+
+def meter():
+    return _meter
@@ -0,0 +1,65 @@
+# bluetooth.py
+import time
+import shutil
+import subprocess
+import threading
+
+import config
+
+# BlueZ announces connects and disconnects as property changes on org.bluez.Device1.
+_BLUEZ_MATCH = ("type='signal',sender='org.bluez',interface='org.freedesktop.DBus.Properties',"
+                "member='PropertiesChanged',arg0='org.bluez.Device1'")
+
+def _query_connected():
+    """Asks the controller whether any device is connected; None if it can't be asked."""
+    try:
+        result = subprocess.run(["hcitool", "con"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                timeout=5, check=True)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return "ACL" in result.stdout.decode(errors='ignore')
+
+class PresenceMonitor:
+    """
+    Keeps track of whether the phone is connected over Bluetooth, so /status only
+    reads a value from memory. One thread polls hcitool every
+    config.BLUETOOTH_POLL_SECONDS; where dbus-monitor is available, BlueZ
+    connection events wake it up early, so changes show up right away.
+    """
+
+    def __init__(self):
+        self.connected = False
+        self.checked_at = None  # When the state was last read from the controller
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._poll_loop, name="bluetooth-presence", daemon=True)
+        self._thread.start()
+        if shutil.which("dbus-monitor"):
+            threading.Thread(target=self._event_loop, name="bluetooth-events", daemon=True).start()
+
+    def _poll_loop(self):
+        while True:
+            connected = _query_connected()
+            if connected is not None:
+                self.connected = connected
+                self.checked_at = time.time()
+            self._wakeup.wait(config.BLUETOOTH_POLL_SECONDS)
+            self._wakeup.clear()
+
+    def _event_loop(self):
+        """Wakes the poller whenever BlueZ reports a device's Connected property changing."""
+        try:
+            proc = subprocess.Popen(["dbus-monitor", "--system", _BLUEZ_MATCH],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            return
+        for raw in iter(proc.stdout.readline, b""):
+            if b'"Connected"' in raw:
+                self._wakeup.set()
+        proc.wait()
+
+presence = PresenceMonitor()
@@ -1,142 +1,370 @@
 # camera_handler.py
 import subprocess
-import threading
 import os
 import time
-import json
-from PIL import Image, ImageDraw, ImageFont
+import signal
+import threading
 
-import state
 import config
-from youtube_uploader import upload_to_youtube
-
-def record_video(song):
-    """Handles the entire recording process in a thread."""
-    while state.snapshot_lock.locked():
-        time.sleep(0.1)
-
-    state.RECORDING = True
-
-    safe_name = "".join(c for c in song if c.isalnum() or c in (' ', '_', '-')).rstrip()
-    dest_video = f"static/{safe_name}.mp4"
-    dest_thumbnail = f"static/{safe_name}.png"
-
-    cmd = [
-        "rpicam-vid", "-t", "0", "-o", dest_video,
-        "--width", "1280", "--height", "720", "--framerate", "30",
-        "--mode", "2304:1296", "--codec", "libav", "--libav-format", "mp4",
-        "--nopreview", "--flush"
-    ]
-
-    state.RECORD_PROC = subprocess.Popen(cmd, stderr=subprocess.PIPE, preexec_fn=os.setsid)
-    _, err = state.RECORD_PROC.communicate()
-
-    return_code = state.RECORD_PROC.returncode
-    video_exists = os.path.exists(dest_video)
-    video_size = os.path.getsize(dest_video) if video_exists else 0
-
-    if return_code != 0 and err:
-        print("--- rpicam-vid ERROR ---")
-        print(err.decode(errors='ignore'))
-        print("------------------------")
-
-    if return_code != 0:
-        time.sleep(1)
-
-    if not video_exists or video_size == 0:
-        print(f"Recording failed or resulted in an empty file. Code: {return_code}")
-        if video_exists: os.remove(dest_video)
-        state.RECORDING = False
-        state.RECORD_PROC = None
-        return
-
-    make_splash(song, dest_thumbnail)
-
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    with open(os.path.join(script_dir, config.COLORS_PATH), 'r') as f:
-        color_data = json.load(f)
-        playlist_date_str = color_data.get("last_updated", time.strftime("%Y-%m-%d"))
-
-    state.UPLOAD_STATUS[dest_video] = {'title': song, 'status': 'Waiting...'}
-    upload_thread = threading.Thread(target=upload_to_youtube, args=(dest_video, dest_thumbnail, song, playlist_date_str))
-    upload_thread.start()
-
-    state.RECORDING = False
-    state.CURRENT_SONG = None
-    state.RECORD_PROC = None
-
-def take_snapshot():
-    """Takes a snapshot, returns the file path or raises an exception."""
-    if state.RECORDING:
-        return "static/snapshot.jpg"
-
-    tmpfile = "static/snapshot.jpg"
-    got_lock = state.snapshot_lock.acquire(blocking=False)
-    if not got_lock:
-        return "static/snapshot.jpg"
-
-    try:
-        subprocess.run([
-            "rpicam-still", "-o", tmpfile,
-            "--width", "640", "--height", "360", "-t", "100",
-            "--mode", "2304:1296", "--nopreview"
-        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return tmpfile
-    finally:
-        state.snapshot_lock.release()
-
-def make_splash(songname, splash_path, width=1280, height=720):
-    """Creates a splash screen image for the video thumbnail."""
-    try:
-        with open(config.COLORS_PATH, 'r') as f:
-            color_data = json.load(f)
-            active_index = color_data.get("active_index", 0)
-            colors = color_data.get("colors", ["#000000"])
-            background_color_hex = colors[active_index]
-    except (FileNotFoundError, IndexError):
-        background_color_hex = "#000000"
-
-    h = background_color_hex.lstrip('#')
-    r, g, b = tuple(int(h[i:i+2], 16) for i in (0, 2, 4))
-    luminance = (0.299 * r + 0.587 * g + 0.114 * b) / 255
-    text_color = "#000000" if luminance > 0.5 else "#FFFFFF"
-
-    img = Image.new('RGB', (width, height), color=background_color_hex)
-    draw = ImageDraw.Draw(img)
-
-    try:
-        font_title = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 80)
-        font_date = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 40)
-    except Exception:
-        font_title = ImageFont.load_default()
-        font_date = ImageFont.load_default()
-
-    title_text = songname
-    try:
-        title_bbox = draw.textbbox((0, 0), title_text, font=font_title)
-        title_w, title_h = title_bbox[2] - title_bbox[0], title_bbox[3] - title_bbox[1]
-    except AttributeError:
-        title_w, title_h = draw.textsize(title_text, font=font_title)
-
-    draw.text(
-        ((width - title_w) / 2, (height / 2) - title_h),
-        title_text,
-        font=font_title,
-        fill=text_color
-    )
-
-    date_text = time.strftime("%d %B at %H:%M", time.localtime())
-    try:
-        date_bbox = draw.textbbox((0, 0), date_text, font=font_date)
-        date_w, _ = date_bbox[2] - date_bbox[0], date_bbox[3] - date_bbox[1]
-    except AttributeError:
-        date_w, _ = draw.textsize(date_text, font=font_date)
-
-    draw.text(
-        ((width - date_w) / 2, (height / 2) + 20),
-        date_text,
-        font=font_date,
-        fill=text_color
-    )
-
-    img.save(splash_path, format="PNG")
\ No newline at end of file
+import store
+import events
+import thumbnails
+from live_upload import LiveUpload
+from camera_service import get_camera
+from preview import PreviewProducer
+from audio_meter import meter as audio_meter
+from recorder_monitor import RecorderMonitor
+from write_path import TakeWriter
+from postprocess import Take, take_name, take_title, queue_take, queue_set
+
+class CameraDevice:
+    """
+    One camera with its own recorder state, preview and snapshots. "csi" cameras
+    are recorded with rpicam-vid (or the picamera2 service), "usb" webcams with
+    ffmpeg. Devices are created from config.CAMERAS by devices.registry().
+    """
+
+    def __init__(self, spec, angle=None):
+        self.name = spec["name"]
+        self.kind = spec.get("type", "csi")
+        self.index = spec.get("index", 0)  # CSI camera number
+        self.path = spec.get("device")  # V4L2 device of a USB webcam
+        self.spec = spec
+        self.records_audio = spec.get("audio", False)
+        self.angle = angle  # Tag of this camera's uploads, None with a single camera
+        self.recording = False
+        self.pending = False  # Reserved by devices.start() for a take that hasn't started recording yet
+        self.cancelled = False  # Stopped while pending; the take ends before the recorder starts
+        self._take_lock = threading.Lock()  # Orders stop() against the recorder starting
+        self.current_song = None
+        self.take_started = None  # time.time() the current take started, for storage.admit_take()
+        self.proc = None
+        self.monitor = None
+        self.last_metrics = None  # Recorder metrics of the last take
+        self.last_take_write = None  # Write stats of the last take, see write_path.TakeWriter
+        # Held by whatever has the camera open outside a take: rpicam-still/ffmpeg for a
+        # snapshot, or the preview process. A take waits for it before recording.
+        self.camera_lock = threading.Lock()
+        self.snapshot_sequence = 0  # Number of the newest snapshot, for its ETag
+        self._snapshot = None  # (sequence, taken at, JPEG bytes) of the newest snapshot
+        self._snapshot_state = threading.Condition()
+        self._capturing = False
+        self._capture_generation = 0  # Bumped when a capture ends, to wake the callers sharing it
+        self._capture_result = None  # (sequence, jpeg) or the exception of the last capture
+        self.preview = PreviewProducer(self)
+
+    def service(self):
+        """The picamera2 service of this camera, or None when it is driven by a subprocess."""
+        return get_camera(self.index) if self.kind == "csi" else None
+
+    def preview_command(self):
+        if self.kind == "usb":
+            return [
+                "ffmpeg", "-nostdin", "-loglevel", "error", "-f", "v4l2", "-i", self.path,
+                "-vf", f"scale={config.PREVIEW_WIDTH}:{config.PREVIEW_HEIGHT}", "-r", str(config.PREVIEW_MAX_FPS),
+                "-c:v", "mjpeg", "-q:v", "5", "-f", "mjpeg", "-"
+            ]
+        return [
+            "rpicam-vid", "-t", "0", "-o", "-", "--codec", "mjpeg", "--camera", str(self.index),
+            "--width", str(config.PREVIEW_WIDTH), "--height", str(config.PREVIEW_HEIGHT),
+            "--framerate", str(config.PREVIEW_MAX_FPS),
+            "--mode", f"{config.SENSOR_MODE[0]}:{config.SENSOR_MODE[1]}",
+            "--nopreview"
+        ]
+
+    def _record_command(self, record_path, video_format, profile, writer):
+        if self.kind == "usb":
+            width = self.spec.get("width", profile["width"])
+            height = self.spec.get("height", profile["height"])
+            framerate = self.spec.get("framerate", profile["framerate"])
+            cmd = [
+                "ffmpeg", "-nostdin", "-y", "-loglevel", "error",
+                "-f", "v4l2", "-framerate", str(framerate), "-video_size", f"{width}x{height}", "-i", self.path,
+                "-c:v", profile["video_codec"], "-b:v", str(profile["bitrate"]),
+            ]
+            if profile["video_codec"] == "libx264":
+                cmd += ["-preset", "veryfast"]
+            return cmd + ["-f", video_format, record_path]
+
+        cmd = [
+            "rpicam-vid", "-t", "0", "-o", record_path, "--camera", str(self.index),
+            "--width", str(profile["width"]), "--height", str(profile["height"]),
+            "--framerate", str(profile["framerate"]), "--bitrate", str(profile["bitrate"]),
+            "--mode", f"{profile['mode'][0]}:{profile['mode'][1]}",
+            "--codec", "libav", "--libav-format", video_format,
+            "--libav-video-codec", profile["video_codec"],
+            "--nopreview", "-v", "2"
+        ] + writer.recorder_flags()
+        if config.AUDIO_ENABLED and self.records_audio:
+            cmd += [
+                "--libav-audio", "--audio-source", "alsa", "--audio-device", config.AUDIO_DEVICE,
+                "--audio-codec", "aac", "--audio-channels", str(config.AUDIO_CHANNELS),
+                "--audio-samplerate", str(config.AUDIO_SAMPLE_RATE)
+            ]
+        return cmd
+
+    def record(self, song, set_split, profile, ready):
+        """
+        Records one take; runs in a worker of the devices pool. All cameras of a
+        session wait on the ready barrier, so they start recording together. In set
+        mode (set_split given) the recording is a whole run-through that is split into
+        songs afterwards.
+        """
+        camera = self.service()
+        if camera is None:
+            # The take is already reserved (pending), so the preview doesn't start again meanwhile.
+            self.preview.release_camera()
+            if self.records_audio:
+                audio_meter().release_device()
+        with self.camera_lock:
+            # Waits for a running snapshot capture to release the camera; captures check recording under this lock.
+            self.recording = True
+        self.current_song = song
+        events.recording_changed(self)
+
+        if self.records_audio:
+            audio_meter().reset_clips()
+        take_started = self.take_started = time.time()
+        # Render the thumbnail while recording, so the stop -> upload path finds it cached.
+        thumbnails.prerender(song, take_started)
+
+        name = take_name(song, take_started, self.angle)
+        video_format = config.STREAM_UPLOAD_FORMAT if config.STREAM_UPLOAD else "mp4"
+        video_extension = config.STREAM_UPLOAD_EXTENSION if config.STREAM_UPLOAD else "mp4"
+        os.makedirs(config.RECORDINGS_DIR, exist_ok=True)
+        dest_video = os.path.join(config.RECORDINGS_DIR, f"{name}.{video_extension}")
+        dest_thumbnail = os.path.join(config.RECORDINGS_DIR, f"{name}.png")
+
+        write_mode = config.RECORD_WRITE_MODE
+        if write_mode == "tmpfs" and config.STREAM_UPLOAD:
+            # The live upload follows the file the recorder writes, which tmpfs mode frees as it spills.
+            write_mode = "interval"
+        writer = TakeWriter(dest_video, write_mode)
+        live_upload = None
+        try:
+            writer.start()
+
+            playlist_date_str = store.playlist_date_str()
+
+            try:
+                ready.wait()
+            except threading.BrokenBarrierError:
+                print(f"Camera '{self.name}': the other cameras did not get ready, not recording.")
+                writer.abort()
+                self.reset()
+                return
+
+            with self._take_lock:
+                self.pending = False
+                if self.cancelled:
+                    print(f"Camera '{self.name}': stopped before recording started.")
+                    writer.abort()
+                    self.reset()
+                    return
+                if camera is not None:
+                    camera.start_recording(writer.record_path)
+                    is_running = camera.is_recording
+                else:
+                    cmd = self._record_command(writer.record_path, video_format, profile, writer)
+                    self.proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, preexec_fn=os.setsid)
+                    self.monitor = RecorderMonitor(self.proc.stderr, profile["framerate"]).start()
+                    is_running = lambda: self.proc.poll() is None
+
+            if config.STREAM_UPLOAD and set_split is None:
+                # The recorder creates the output file as it starts up
+                while not os.path.exists(dest_video) and is_running():
+                    time.sleep(0.1)
+                if os.path.exists(dest_video):
+                    live_upload = LiveUpload(dest_video, dest_thumbnail, take_title(song, self.angle),
+                                             playlist_date_str, self.angle)
+                    live_upload.start()
+        except Exception:
+            # Don't leave a flush/spill thread, a preallocated file or a recorder behind.
+            if live_upload:
+                live_upload.abort()
+            if self.proc is not None and self.proc.poll() is None:
+                os.killpg(os.getpgid(self.proc.pid), signal.SIGTERM)
+                self.proc.wait()
+            elif camera is not None and camera.is_recording():
+                camera.stop_recording()
+            writer.abort()
+            raise
+
+        if camera is not None:
+            camera.wait_until_stopped()
+            return_code, err = 0, None
+        else:
+            return_code = self.proc.wait()
+            self.monitor.join()
+            err = self.monitor.tail_text()
+            self.last_metrics = self.monitor.metrics()
+            print(f"Take finished on '{self.name}': {self.last_metrics}")
+
+        video_exists = os.path.exists(writer.record_path)
+        video_size = os.path.getsize(writer.record_path) if video_exists else 0
+
+        if return_code != 0 and err:
+            print(f"--- {self.name} recorder ERROR ---")
+            print(err)
+            print("------------------------")
+
+        if return_code != 0:
+            time.sleep(1)
+
+        if not video_exists or video_size == 0:
+            print(f"Recording on '{self.name}' failed or resulted in an empty file. Code: {return_code}")
+            if live_upload:
+                live_upload.abort()
+            writer.abort()
+            self.reset()
+            return
+
+        self.last_take_write = writer.finish()
+        if self.records_audio and audio_meter().clipped_total():
+            print(f"WARNING: the audio of '{song}' clipped {audio_meter().clipped_total()} samples.")
+        take = Take(dest_video, dest_thumbnail, song, playlist_date_str, take_started, self.angle)
+        if live_upload:
+            live_upload.finish()
+            queue_take(take, on_done=live_upload.thumbnail_ready)
+        elif set_split is not None:
+            queue_set(take, set_split, self.name)
+        else:
+            queue_take(take)
+        self.reset()
+
+    def busy(self):
+        """True from the moment a take is reserved until it has finished."""
+        return self.recording or self.pending
+
+    def reset(self):
+        self.recording = False
+        self.pending = False
+        self.cancelled = False
+        self.current_song = None
+        self.take_started = None
+        self.proc = None
+        self.monitor = None
+        events.recording_changed(self)
+
+    def stop(self):
+        """Stops the take in progress, or cancels one that hasn't started yet. Returns False if there was none."""
+        with self._take_lock:
+            if self.pending:
+                self.cancelled = True
+                return True
+        camera = self.service()
+        if camera is not None:
+            return camera.stop_recording()
+        if self.proc and self.recording:
+            # Use os.killpg to send the signal to the entire process group.
+            # This is a more robust way to terminate the process.
+            os.killpg(os.getpgid(self.proc.pid), signal.SIGINT)
+            return True
+        return False
+
+    def status(self):
+        monitor = self.monitor
+        return {
+            "recording": self.recording,
+            "song": self.current_song,
+            "recorder": monitor.metrics() if monitor else None,
+            "last_take_write": self.last_take_write,
+        }
+
+    def snapshot(self):
+        """
+        Returns (sequence, jpeg) of a snapshot, or raises an exception. Only one
+        capture runs at a time: callers arriving meanwhile wait for it and share its
+        frame, and a frame younger than config.SNAPSHOT_TTL_SECONDS is returned
+        without capturing again. Nobody waits much longer than
+        config.SNAPSHOT_CAPTURE_TIMEOUT_SECONDS: a stuck capture is killed, and
+        meanwhile waiting callers get the last frame.
+        """
+        with self._snapshot_state:
+            latest = self._snapshot
+            if latest is not None and time.time() - latest[1] < config.SNAPSHOT_TTL_SECONDS:
+                return latest[0], latest[2]
+            if self._capturing:
+                generation = self._capture_generation
+                if not self._snapshot_state.wait_for(lambda: self._capture_generation != generation,
+                                                     timeout=config.SNAPSHOT_CAPTURE_TIMEOUT_SECONDS + 1):
+                    if latest is None:
+                        raise RuntimeError(f"Camera '{self.name}' did not deliver a snapshot in time")
+                    return latest[0], latest[2]
+                if isinstance(self._capture_result, Exception):
+                    raise self._capture_result
+                return self._capture_result
+            self._capturing = True
+
+        try:
+            jpeg = self._capture()
+            if jpeg is not None:
+                self.snapshot_sequence += 1
+                self._snapshot = (self.snapshot_sequence, time.time(), jpeg)
+                if config.SNAPSHOT_PERSIST:
+                    self._write_snapshot(os.path.join("static", f"snapshot-{self.name}.jpg"), jpeg)
+            elif self._snapshot is None:
+                raise RuntimeError(f"Camera '{self.name}' is busy and has no earlier snapshot")
+            # A busy camera keeps showing its last snapshot.
+            result = (self._snapshot[0], self._snapshot[2])
+        except Exception as e:
+            result = e
+        with self._snapshot_state:
+            self._capturing = False
+            self._capture_result = result
+            self._capture_generation += 1
+            self._snapshot_state.notify_all()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _capture(self):
+        """JPEG bytes of a new frame, or None while the camera is taken by a recording."""
+        camera = self.service()
+        if camera is not None:
+            # The warm camera always has a fresh preview frame, also while recording.
+            return camera.snapshot()
+
+        if self.recording:
+            return None
+
+        if self.preview.owns_camera():
+            # The MJPEG preview holds the camera; use its newest frame, waiting for the
+            # first one while it starts up, rather than opening the sensor twice.
+            return self.preview.current_frame(timeout=2.0)
+
+        if not self.camera_lock.acquire(blocking=False):
+            return None
+
+        try:
+            if self.recording:
+                return None
+            if self.kind == "usb":
+                cmd = [
+                    "ffmpeg", "-nostdin", "-loglevel", "error", "-f", "v4l2", "-i", self.path,
+                    "-frames:v", "1", "-vf", f"scale={config.PREVIEW_WIDTH}:{config.PREVIEW_HEIGHT}",
+                    "-c:v", "mjpeg", "-f", "image2pipe", "-"
+                ]
+            else:
+                cmd = [
+                    "rpicam-still", "-o", "-", "--camera", str(self.index),
+                    "--width", str(config.PREVIEW_WIDTH), "--height", str(config.PREVIEW_HEIGHT), "-t", "100",
+                    "--mode", f"{config.SENSOR_MODE[0]}:{config.SENSOR_MODE[1]}", "--nopreview"
+                ]
+            result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    timeout=config.SNAPSHOT_CAPTURE_TIMEOUT_SECONDS)
+            if not result.stdout:
+                raise RuntimeError(f"Camera '{self.name}' returned an empty snapshot")
+            return result.stdout
+        finally:
+            self.camera_lock.release()
+
+    def _write_snapshot(self, path, jpeg):
+        partial = path + ".part"
+        with open(partial, 'wb') as f:
+            f.write(jpeg)
+        os.replace(partial, path)
+
+    def snapshot_etag(self, sequence):
+        """Identifies snapshot number sequence; changes with every new one and across restarts."""
+        return f"{self.name}-{events.BOOT_ID}-{sequence}"
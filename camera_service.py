@@ -0,0 +1,205 @@
+# camera_service.py
+import io
+import threading
+import subprocess
+from collections import deque
+
+import config
+
+try:
+    from picamera2 import Picamera2
+    from picamera2.encoders import H264Encoder, MJPEGEncoder, JpegEncoder
+    from picamera2.outputs import Output, FileOutput, FfmpegOutput
+except ImportError:
+    Picamera2 = None
+    Output = object
+
+class LatestFrame(io.BufferedIOBase):
+    """Encoder output that keeps only the newest JPEG frame and wakes up anyone waiting for it."""
+
+    def __init__(self):
+        self.frame = None
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        with self.condition:
+            self.frame = bytes(buf)
+            self.sequence += 1
+            self.condition.notify_all()
+        return len(buf)
+
+    def wait_for_frame(self, after_sequence=0, timeout=2.0):
+        """Returns (sequence, jpeg) for the first frame newer than after_sequence, or (None, None) on timeout."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence > after_sequence, timeout=timeout):
+                return None, None
+            return self.sequence, self.frame
+
+class PrerollOutput(Output):
+    """
+    Encoder output that keeps the last config.PREROLL_SECONDS of H.264 in memory
+    and, when a take starts, writes that buffer followed by the live stream into
+    the take, without re-encoding.
+
+    The ring holds whole GOPs (keyframe to keyframe), each stored as a single
+    bytearray, so a take always starts on a keyframe and old data is dropped a
+    GOP at a time. Memory is capped by config.PREROLL_MAX_BYTES.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._gops = deque()  # [first_timestamp_us, bytearray] per GOP, oldest first
+        self._buffered_bytes = 0
+        self._lock = threading.Lock()
+        self._muxer = None
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        with self._lock:
+            if self._muxer is not None:
+                self._write_to_take(frame)
+                return
+            if keyframe:
+                self._gops.append([timestamp or 0, bytearray()])
+            elif not self._gops:
+                return  # Wait for a keyframe so the buffer always starts with one
+            self._gops[-1][1] += frame
+            self._buffered_bytes += len(frame)
+            self._evict(timestamp or 0)
+
+    def _evict(self, now_us):
+        # Always keep the GOP being filled; drop older ones that are too old or over the byte cap.
+        max_age_us = config.PREROLL_SECONDS * 1000000
+        while len(self._gops) > 1 and (
+            now_us - self._gops[1][0] >= max_age_us or self._buffered_bytes > config.PREROLL_MAX_BYTES
+        ):
+            _, data = self._gops.popleft()
+            self._buffered_bytes -= len(data)
+
+    def _write_to_take(self, data):
+        try:
+            self._muxer.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            pass
+
+    def start_take(self, path):
+        """Starts a take in path: the buffered pre-roll first, then the live frames."""
+        with self._lock:
+            self._muxer = subprocess.Popen(
+                ["ffmpeg", "-nostdin", "-y", "-loglevel", "error",
+                 "-f", "h264", "-framerate", str(config.RECORD_FRAMERATE), "-i", "-",
+                 "-c:v", "copy", path],
+                stdin=subprocess.PIPE
+            )
+            for _, data in self._gops:
+                self._write_to_take(data)
+            self._gops.clear()
+            self._buffered_bytes = 0
+
+    def stop_take(self):
+        with self._lock:
+            muxer, self._muxer = self._muxer, None
+        if muxer is not None:
+            muxer.stdin.close()
+            muxer.wait()
+
+class CameraService:
+    """
+    Owns the camera for the lifetime of the process. The sensor keeps streaming
+    so a low-resolution JPEG preview is always available, and a recording is
+    started by attaching an H.264 encoder to the running pipeline instead of
+    spawning rpicam-vid, which re-initialises libcamera every time.
+    """
+
+    def __init__(self, index=0):
+        self.index = index
+        self.preview = LatestFrame()
+        self._picam = None
+        self._lock = threading.Lock()
+        self._record_encoder = None
+        self._preroll = None
+        self._recording_stopped = threading.Event()
+
+    def start(self):
+        picam = Picamera2(self.index)
+        video_config = picam.create_video_configuration(
+            main={"size": (config.RECORD_WIDTH, config.RECORD_HEIGHT)},
+            lores={"size": (config.PREVIEW_WIDTH, config.PREVIEW_HEIGHT)},
+            sensor={"output_size": config.SENSOR_MODE},
+            controls={"FrameRate": config.RECORD_FRAMERATE},
+        )
+        picam.configure(video_config)
+        picam.start()
+        try:
+            preview_encoder = MJPEGEncoder()
+            picam.start_encoder(preview_encoder, FileOutput(self.preview), name="lores")
+        except Exception:
+            # No hardware JPEG encoder (e.g. Pi 5), encode the preview in software.
+            preview_encoder = JpegEncoder(q=config.PREVIEW_QUALITY)
+            picam.start_encoder(preview_encoder, FileOutput(self.preview), name="lores")
+        if config.PREROLL_SECONDS > 0:
+            # The recording encoder runs all the time and feeds the pre-roll ring between takes.
+            self._preroll = PrerollOutput()
+            encoder = H264Encoder(bitrate=config.RECORD_BITRATE, repeat=True,
+                                  iperiod=config.PREROLL_KEYFRAME_INTERVAL)
+            picam.start_encoder(encoder, self._preroll, name="main")
+        self._picam = picam
+        print(f"Camera service started for camera {self.index}.")
+
+    def snapshot(self, timeout=2.0):
+        """Returns the newest preview frame as JPEG bytes."""
+        _, frame = self.preview.wait_for_frame(timeout=timeout)
+        if frame is None:
+            raise RuntimeError("Camera service did not deliver a preview frame")
+        return frame
+
+    def start_recording(self, path):
+        """Starts encoding the main stream into path; the container follows the file extension."""
+        with self._lock:
+            if self._record_encoder is not None:
+                raise RuntimeError("Camera service is already recording")
+            self._recording_stopped.clear()
+            if self._preroll is not None:
+                self._preroll.start_take(path)
+                self._record_encoder = self._preroll
+                return
+            encoder = H264Encoder(bitrate=config.RECORD_BITRATE)
+            self._picam.start_encoder(encoder, FfmpegOutput(path), name="main")
+            self._record_encoder = encoder
+
+    def stop_recording(self):
+        with self._lock:
+            if self._record_encoder is None:
+                return False
+            if self._record_encoder is self._preroll:
+                self._preroll.stop_take()
+            else:
+                self._picam.stop_encoder(self._record_encoder)
+            self._record_encoder = None
+            self._recording_stopped.set()
+            return True
+
+    def is_recording(self):
+        return self._record_encoder is not None
+
+    def wait_until_stopped(self):
+        self._recording_stopped.wait()
+
+_services = {}
+_service_lock = threading.Lock()
+
+def get_camera(index=0):
+    """Returns the running camera service for a CSI camera, or None when config.CAMERA_BACKEND is 'rpicam'."""
+    if config.CAMERA_BACKEND != "picamera2":
+        return None
+    with _service_lock:
+        if index not in _services:
+            if Picamera2 is None:
+                raise RuntimeError("CAMERA_BACKEND is 'picamera2' but picamera2 is not installed")
+            service = CameraService(index)
+            service.start()
+            _services[index] = service
+        return _services[index]
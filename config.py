@@ -2,7 +2,167 @@
 
 SONGS_PATH = "songs.json"
 COLORS_PATH = "colors.json"
-FAILED_UPLOADS_PATH = "failed_uploads.json"
+FAILED_UPLOADS_PATH = "failed_uploads.json"  # Legacy retry list, imported into the upload queue on startup
+UPLOAD_QUEUE_PATH = "upload_queue.db"
+PLAYLIST_INDEX_PATH = "playlists.json"  # Cached playlist title -> ID mapping
+
+# Thumbnails
+THUMBNAIL_CACHE_SIZE = 64  # Rendered thumbnails kept in memory
+THUMBNAIL_BUCKET_MINUTES = 1  # Time resolution of the date shown on thumbnails
+THUMBNAIL_PNG_COMPRESS_LEVEL = 1  # zlib level; flat splash images compress well even at 1
+THUMBNAIL_MODE = "splash"  # "frame" picks the best frame of the take instead (needs numpy and ffmpeg)
+FRAME_THUMBNAIL_SAMPLES = 12  # Keyframes sampled across the take
+FRAME_THUMBNAIL_BUDGET_SECONDS = 20  # Give up and keep the splash after this long
+
+# Camera
+# "rpicam" spawns rpicam-vid/rpicam-still for every take and snapshot.
+# "picamera2" keeps the camera running in-process (python3-picamera2), so takes
+# start instantly and snapshots come from the live preview stream.
+CAMERA_BACKEND = "rpicam"
+# Cameras to record, first one is the default for previews and snapshots.
+# "csi" cameras are numbered like rpicam-vid --camera; "usb" webcams are
+# recorded with ffmpeg from their V4L2 device and may set their own
+# "width"/"height"/"framerate". With more than one camera, uploads are tagged
+# with the camera name as the angle. "audio" picks the camera that records sound.
+CAMERAS = [
+    {"name": "main", "type": "csi", "index": 0, "audio": True},
+    # {"name": "side", "type": "usb", "device": "/dev/video8", "width": 1280, "height": 720, "framerate": 30},
+]
+CAMERA_START_TIMEOUT_SECONDS = 10  # How long cameras wait for each other at a synchronised start
+RECORD_WIDTH = 1280  # picamera2 backend; rpicam-vid takes use ENCODING_PROFILES
+RECORD_HEIGHT = 720
+RECORD_FRAMERATE = 30
+RECORD_BITRATE = 5000000  # H.264 bitrate used by the picamera2 backend
+SENSOR_MODE = (2304, 1296)  # Sensor mode for previews and snapshots
+RECORDER_STDERR_TAIL_LINES = 50  # rpicam-vid log lines kept for error reports
+RECORDER_STALL_SECONDS = 3  # Report the encoder as stalled after this long without a frame
+PREVIEW_WIDTH = 640
+PREVIEW_HEIGHT = 360
+PREVIEW_QUALITY = 80  # JPEG quality when the preview is encoded in software
+PREVIEW_MAX_FPS = 10  # Frame rate cap for /preview.mjpg clients
+SNAPSHOT_TTL_SECONDS = 1.0  # Snapshots younger than this are served from memory instead of captured again
+SNAPSHOT_CAPTURE_TIMEOUT_SECONDS = 5  # A snapshot capture still running after this long is killed
+SNAPSHOT_PERSIST = False  # Also write each new snapshot to static/snapshot-<camera>.jpg
+
+# Encoding profiles (rpicam backend), best first. "video_codec" is rpicam-vid's
+# --libav-video-codec: h264_v4l2m2m is the hardware encoder (Pi 4 and older),
+# libx264 encodes in software and is only used where there is no hardware encoder.
+ENCODING_PROFILES = [
+    {"name": "1080p30-hw", "width": 1920, "height": 1080, "framerate": 30, "bitrate": 8000000,
+     "video_codec": "h264_v4l2m2m", "mode": (2304, 1296)},
+    {"name": "720p30-hw", "width": 1280, "height": 720, "framerate": 30, "bitrate": 5000000,
+     "video_codec": "h264_v4l2m2m", "mode": (2304, 1296)},
+    {"name": "720p30", "width": 1280, "height": 720, "framerate": 30, "bitrate": 4000000,
+     "video_codec": "libx264", "mode": (2304, 1296)},
+    {"name": "720p25", "width": 1280, "height": 720, "framerate": 25, "bitrate": 3000000,
+     "video_codec": "libx264", "mode": (2304, 1296)},
+    {"name": "540p25", "width": 960, "height": 540, "framerate": 25, "bitrate": 2000000,
+     "video_codec": "libx264", "mode": (2304, 1296)},
+]
+ENCODING_PROFILE = "auto"  # A profile name to always use it, or "auto" to let the governor pick
+ENCODING_STATE_PATH = "encoding_state.json"  # The governor's current profile, kept across restarts
+GOVERNOR_SAMPLE_SECONDS = 2  # CPU/temperature sampling interval during a take
+GOVERNOR_TEMP_LIMIT_C = 80  # The SoC starts throttling here; a take that reaches it steps down
+GOVERNOR_TEMP_MARGIN_C = 10  # Step up only after takes that stayed this far below the limit
+GOVERNOR_CPU_LIMIT = 0.85  # Mean CPU load that counts as strained
+GOVERNOR_DROP_LIMIT = 0.01  # Fraction of dropped frames that counts as strained
+GOVERNOR_STEP_UP_TAKES = 3  # Comfortable takes in a row before trying the next profile up
+
+# Audio (rpicam backend): record a USB sound card alongside the video
+AUDIO_ENABLED = False
+AUDIO_DEVICE = "plughw:1"  # ALSA device, see `arecord -l`; a "dsnoop" device keeps the meter running during takes
+AUDIO_CHANNELS = 1
+AUDIO_SAMPLE_RATE = 48000
+AUDIO_METER_BLOCK_SECONDS = 0.05  # PCM block per level reading
+AUDIO_METER_IDLE_SECONDS = 10  # The meter stops capturing when nobody has polled it for this long
+AUDIO_WINDOW_SECONDS = 0.5  # RMS window for level analysis
+AUDIO_SUSTAIN_SECONDS = 4  # Level is smoothed over this long, so short noises don't count as music
+AUDIO_MUSIC_BELOW_PEAK_DB = 25  # Music is anything within this many dB of the take's loud passages
+
+# Silence trimming: cut the talking/tuning before and after the song by stream
+# copy (no re-encode) before the take is uploaded. Needs AUDIO_ENABLED and numpy.
+TRIM_SILENCE = False
+TRIM_PAD_SECONDS = 2  # Kept before and after the music
+TRIM_MIN_SECONDS = 10  # Don't bother cutting when less than this would be removed
+
+# Set mode: record a whole run-through in one take and split it into songs
+# afterwards, titled in setlist order (active songs in songs.json). Needs
+# AUDIO_ENABLED and numpy.
+SET_MIN_GAP_SECONDS = 8  # Quieter stretches shorter than this stay inside a song
+SET_MIN_SONG_SECONDS = 60  # Shorter bursts of sound between songs are dropped
+
+# Pre-roll (picamera2 backend only): keep encoding between takes and start each
+# take with the last few seconds before Start was pressed. 0 disables it.
+PREROLL_SECONDS = 0
+PREROLL_MAX_BYTES = 32 * 1024 * 1024  # Hard memory cap for the pre-roll buffer
+PREROLL_KEYFRAME_INTERVAL = 30  # Frames per GOP; the pre-roll is trimmed a GOP at a time
+
+# Recording write path
+RECORDINGS_DIR = "static"  # Where takes and thumbnails are kept until uploaded
+# "flush": rpicam-vid --flush forces every frame to the SD card (high write amplification).
+# "interval": let the page cache batch writes and fsync every RECORD_FLUSH_INTERVAL seconds.
+# "tmpfs": record into RAM (RECORD_TMPFS_DIR) and spill to RECORDINGS_DIR in large writes.
+RECORD_WRITE_MODE = "interval"
+RECORD_FLUSH_INTERVAL = 5  # Seconds between fsyncs (interval) or spills (tmpfs)
+RECORD_TMPFS_DIR = "/dev/shm/observe"
+RECORD_TMPFS_KEEP_HEAD = 1024 * 1024  # Start of the file kept in RAM because muxers rewrite headers there
+RECORD_PREALLOCATE_BYTES = 1024 * 1024 * 1024  # fallocate the destination in tmpfs mode; 0 disables
+
+# Storage
+KEEP_UPLOADED_FILES = False  # Keep local copies after upload; evicted oldest first when space runs low
+STORAGE_HIGH_WATERMARK = 0.90  # Disk usage fraction that triggers eviction of uploaded takes
+STORAGE_LOW_WATERMARK = 0.80  # Eviction stops once usage is back under this
+STORAGE_RESERVE_BYTES = 500 * 1024 * 1024  # Never fill the card past this much free space
+EXPECTED_TAKE_MINUTES = 10  # /start refuses when less than this much recording time is left
+STORAGE_STATUS_CACHE_SECONDS = 5  # /status reuses the disk figures this long instead of recomputing them per poll
+STORAGE_WARN_MINUTES = 30  # /start warns when less than this much recording time is left
+
+# Upload throttle (bytes per second)
+UPLOAD_RATE_RECORDING = 256 * 1024  # While a take is recording; 0 pauses uploads
+UPLOAD_RATE_IDLE = None  # Between takes; None for unlimited
+UPLOAD_RAMP_SECONDS = 20  # Time to ramp back up to UPLOAD_RATE_IDLE after a take stops
+
+# Live upload: send the take to YouTube while it is being recorded.
+# rpicam-vid can't write fragmented MP4, so takes are recorded as MPEG-TS, which
+# only ever grows at the end. The live upload is not held back by the throttle.
+STREAM_UPLOAD = False
+STREAM_UPLOAD_FORMAT = "mpegts"
+STREAM_UPLOAD_EXTENSION = "ts"
+STREAM_UPLOAD_MIMETYPE = "video/mp2t"
+
+# Proxy upload: a small, low-bitrate copy of each take is uploaded first so it
+# can be reviewed on a phone right away; the full-quality file follows.
+PROXY_UPLOAD = False
+PROXY_REPLACE = True  # Delete the proxy from YouTube once the full-quality video is up
+PROXY_HEIGHT = 360
+PROXY_VIDEO_CODEC = "libx264"  # "h264_v4l2m2m" uses the hardware encoder on a Pi 4
+PROXY_VIDEO_BITRATE = "600k"
+PROXY_AUDIO_BITRATE = "64k"
+
+# Server-Sent Events (/events)
+EVENTS_BUFFER_SIZE = 500  # Recent events kept for clients reconnecting with Last-Event-ID
+EVENTS_KEEPALIVE_SECONDS = 15  # Comment line sent on idle connections so proxies keep them open
+EVENTS_STREAM_MAX_SECONDS = 300  # A stream is closed after this long; the browser reconnects with Last-Event-ID
+# Open /events and /preview.mjpg streams each hold a server thread for as long as
+# they last. Above this many, new ones get a 503, so requests like /stop always
+# find a free thread. Keep it well below Gunicorn's --threads.
+MAX_STREAMS = 6
+
+# HTTP caching and compression
+SNAPSHOT_MAX_AGE_SECONDS = 2  # Browsers reuse a snapshot this long before asking again
+STATIC_MAX_AGE_SECONDS = 300  # Then static files are revalidated with their ETag
+GZIP_MIN_BYTES = 512  # JSON responses at least this large are gzipped for clients that accept it
+
+# Bluetooth presence shown in /status
+BLUETOOTH_POLL_SECONDS = 10  # hcitool poll interval; BlueZ events refresh it sooner where dbus-monitor exists
+
+# Upload queue
+UPLOAD_WORKERS = 1  # Parallel uploads; keep low on the Pi's Wi-Fi
+UPLOAD_RETRY_BASE_SECONDS = 60  # First retry delay, doubled after each failure
+UPLOAD_RETRY_MAX_SECONDS = 3600
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Bytes per resumable chunk, must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE_RECORDING = 1024 * 1024  # Smaller chunks while a take is recording, for smoother throttling
+UPLOAD_CHUNK_RETRIES = 3  # Immediate retries of a single chunk on 5xx/429 before the job fails
 
 YOUTUBE_SCOPES = ["https://www.googleapis.com/auth/youtube"]
 YOUTUBE_API_SERVICE_NAME = "youtube"
@@ -0,0 +1,111 @@
+# devices.py
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import state
+from camera_handler import CameraDevice
+from postprocess import SetSplit
+from encoding import governor
+
+_registry = None
+_registry_lock = threading.Lock()
+_pool = None
+
+# Cameras recording right now, and the recorder metrics of those that finished,
+# for the encoding governor, which sees the board as a whole.
+_session_lock = threading.Lock()
+_active = set()
+_governed = False
+_session_metrics = []
+
+def registry():
+    """All cameras from config.CAMERAS by name, in config order; created on first use."""
+    global _registry, _pool
+    with _registry_lock:
+        if _registry is None:
+            tag_angles = len(config.CAMERAS) > 1
+            _registry = {spec["name"]: CameraDevice(spec, spec["name"] if tag_angles else None)
+                         for spec in config.CAMERAS}
+            # One worker per camera supervises its takes.
+            _pool = ThreadPoolExecutor(max_workers=len(_registry), thread_name_prefix="camera")
+        return _registry
+
+def default():
+    """The first camera in config.CAMERAS, used when a request doesn't name one."""
+    return next(iter(registry().values()))
+
+def get(name=None):
+    """The camera called name, the default camera for None; raises KeyError for unknown names."""
+    return default() if name is None else registry()[name]
+
+def select(names=None):
+    """The cameras called names, all of them for None."""
+    return list(registry().values()) if names is None else [get(name) for name in names]
+
+def start(song, names=None, set_mode=False):
+    """
+    Starts a take of song on the named cameras (all when None) that aren't
+    recording yet. They wait for each other and start recording together.
+    Returns the names of the cameras that were started.
+    """
+    global _governed
+    devices = select(names)
+    with _session_lock:
+        # Reserved under the lock, so two quick /start requests can't both start the same camera.
+        targets = [device for device in devices if not device.busy()]
+        if not targets:
+            return []
+        for device in targets:
+            device.pending = True
+            device.cancelled = False
+        if not _active:
+            _session_metrics.clear()
+            # The governor profile only applies to cameras recorded by a subprocess.
+            _governed = any(device.service() is None for device in targets)
+            profile = governor.choose()
+            if _governed:
+                governor.start(profile)
+        else:
+            profile = governor.profile or governor.choose()
+        _active.update(device.name for device in targets)
+        state.RECORDING = True
+
+    ready = threading.Barrier(len(targets), timeout=config.CAMERA_START_TIMEOUT_SECONDS)
+    # The cameras of a set are split into songs where the ones recording audio hear them.
+    set_split = SetSplit(device.name for device in targets if device.records_audio) if set_mode else None
+    for device in targets:
+        _pool.submit(_run_take, device, song, set_split, profile, ready)
+    return [device.name for device in targets]
+
+def stop(names=None):
+    """Stops the named cameras (all when None). Returns the names that were recording."""
+    return [device.name for device in select(names) if device.stop()]
+
+def _run_take(device, song, set_split, profile, ready):
+    try:
+        device.record(song, set_split, profile, ready)
+    except Exception as e:
+        print(f"Recording on '{device.name}' failed: {e}")
+        ready.abort()  # Don't keep the other cameras waiting for this one
+        device.reset()
+    finally:
+        if set_split is not None:
+            set_split.take_ended(device.name)
+        _take_finished(device)
+
+def _take_finished(device):
+    """Ends the session once the last camera stops, and reports it to the encoding governor."""
+    with _session_lock:
+        _active.discard(device.name)
+        if device.last_metrics is not None:
+            _session_metrics.append(device.last_metrics)
+            device.last_metrics = None
+        if _active:
+            return
+        state.RECORDING = False
+        if _governed:
+            governor.finish({
+                "frames": sum(m["frames"] for m in _session_metrics),
+                "dropped_frames": sum(m["dropped_frames"] for m in _session_metrics),
+            })
@@ -0,0 +1,191 @@
+# encoding.py
+import os
+import json
+import threading
+
+import config
+
+_HARDWARE_ENCODER_DEVICE = "/dev/video11"  # bcm2835-codec H.264 encoder, missing on the Pi 5
+_THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+_THROTTLED = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+_THROTTLED_NOW = 0x2 | 0x4  # Arm frequency capped, currently throttled
+
+def available_profiles():
+    """config.ENCODING_PROFILES this board can run, best first; hardware profiles need the encoder device."""
+    hardware = os.path.exists(_HARDWARE_ENCODER_DEVICE)
+    return [p for p in config.ENCODING_PROFILES if hardware or p["video_codec"] != "h264_v4l2m2m"]
+
+def soc_temperature():
+    """SoC temperature in °C, or None where there is no thermal zone."""
+    try:
+        with open(_THERMAL_ZONE) as f:
+            return int(f.read().strip()) / 1000.0
+    except (OSError, ValueError):
+        return None
+
+def is_throttled():
+    try:
+        with open(_THROTTLED) as f:
+            return bool(int(f.read().strip(), 16) & _THROTTLED_NOW)
+    except (OSError, ValueError):
+        return False
+
+def _cpu_times():
+    with open("/proc/stat") as f:
+        fields = [int(v) for v in f.readline().split()[1:]]
+    idle = fields[3] + fields[4]  # idle + iowait
+    return sum(fields), idle
+
+class EncodingGovernor:
+    """
+    Picks the encoding profile for each take and learns what the board can sustain.
+
+    While a take records, CPU load, SoC temperature and the firmware's throttling
+    flag are sampled every config.GOVERNOR_SAMPLE_SECONDS. A take that ran hot,
+    throttled, kept the CPU busy or dropped frames moves the next takes one profile
+    down; config.GOVERNOR_STEP_UP_TAKES comfortable takes in a row move one back up.
+    The current step is kept in config.ENCODING_STATE_PATH across restarts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._samples = []
+        self.profile = None
+        self.last_report = None
+        self._last_choice = None
+        self._warned_pinned = False
+
+    def _load(self):
+        if self._state is None:
+            try:
+                with open(config.ENCODING_STATE_PATH) as f:
+                    self._state = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._state = {"profile": None, "good_takes": 0}
+        return self._state
+
+    def _save(self):
+        with open(config.ENCODING_STATE_PATH, 'w') as f:
+            json.dump(self._state, f, indent=2)
+
+    def _level(self, profiles):
+        names = [p["name"] for p in profiles]
+        current = self._load()["profile"]
+        return names.index(current) if current in names else 0
+
+    def _pinned(self, profiles):
+        """The profile named by config.ENCODING_PROFILE, or None for "auto" or one this board lacks."""
+        if config.ENCODING_PROFILE == "auto":
+            return None
+        for profile in profiles:
+            if profile["name"] == config.ENCODING_PROFILE:
+                return profile
+        if not self._warned_pinned:
+            print(f"Encoding profile '{config.ENCODING_PROFILE}' is not available here, using the governor.")
+            self._warned_pinned = True
+        return None
+
+    def choose(self):
+        """The profile for the next take."""
+        profiles = available_profiles()
+        profile = self._pinned(profiles)
+        if profile is None:
+            with self._lock:
+                level = self._level(profiles)
+            temperature = soc_temperature()
+            if temperature is not None and temperature >= config.GOVERNOR_TEMP_LIMIT_C - config.GOVERNOR_TEMP_MARGIN_C:
+                # Already warm before the take; start one step lower without changing what was learned.
+                level = min(level + 1, len(profiles) - 1)
+            profile = profiles[level]
+        self._last_choice = profile
+        return profile
+
+    def expected(self):
+        """
+        The profile the next take will most likely use, for estimates shown on
+        every /status poll: the last one chosen, or the learned one without
+        reading the board if none has been chosen yet.
+        """
+        if self._last_choice is None:
+            profiles = available_profiles()
+            with self._lock:
+                self._last_choice = self._pinned(profiles) or profiles[self._level(profiles)]
+        return self._last_choice
+
+    def start(self, profile):
+        """Starts sampling the board for a take recorded with profile."""
+        self.profile = profile
+        self._samples = []
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, name="encoding-governor", daemon=True)
+        self._thread.start()
+
+    def finish(self, recorder_metrics=None):
+        """Stops sampling, adjusts the profile for the next takes and returns the take's report."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        loads = [s["cpu"] for s in self._samples if s["cpu"] is not None]
+        temperatures = [s["temperature"] for s in self._samples if s["temperature"] is not None]
+        frames = (recorder_metrics or {}).get("frames") or 0
+        dropped = (recorder_metrics or {}).get("dropped_frames") or 0
+        report = {
+            "profile": self.profile["name"],
+            "cpu_load": round(sum(loads) / len(loads), 2) if loads else None,
+            "max_temperature": max(temperatures) if temperatures else None,
+            "throttled": any(s["throttled"] for s in self._samples),
+            "dropped_fraction": round(dropped / frames, 4) if frames else None,
+        }
+        report["strained"] = bool(
+            report["throttled"]
+            or (report["cpu_load"] or 0) > config.GOVERNOR_CPU_LIMIT
+            or (report["max_temperature"] or 0) >= config.GOVERNOR_TEMP_LIMIT_C
+            or (report["dropped_fraction"] or 0) > config.GOVERNOR_DROP_LIMIT
+        )
+        if config.ENCODING_PROFILE == "auto":
+            self._adjust(report)
+        print(f"Take encoding: {report}")
+        self.last_report = report
+        return report
+
+    def _adjust(self, report):
+        comfortable = not report["strained"] and (report["max_temperature"] or 0) < (
+            config.GOVERNOR_TEMP_LIMIT_C - config.GOVERNOR_TEMP_MARGIN_C)
+        with self._lock:
+            profiles = available_profiles()
+            names = [p["name"] for p in profiles]
+            state = self._load()
+            level = self._level(profiles)
+            taken = names.index(self.profile["name"]) if self.profile["name"] in names else level
+            if report["strained"]:
+                level = min(max(level, taken) + 1, len(profiles) - 1)
+                state["good_takes"] = 0
+            elif comfortable and taken == level:
+                state["good_takes"] += 1
+                if state["good_takes"] >= config.GOVERNOR_STEP_UP_TAKES and level > 0:
+                    level -= 1
+                    state["good_takes"] = 0
+            if names[level] != state["profile"]:
+                print(f"Encoding profile for the next takes: {names[level]}")
+            state["profile"] = names[level]
+            self._save()
+            self._last_choice = None  # expected() follows what was just learned
+
+    def _sample_loop(self):
+        previous = _cpu_times()
+        while not self._stop.wait(config.GOVERNOR_SAMPLE_SECONDS):
+            total, idle = _cpu_times()
+            elapsed = total - previous[0]
+            cpu = round(1 - (idle - previous[1]) / elapsed, 2) if elapsed > 0 else None
+            previous = (total, idle)
+            self._samples.append({
+                "cpu": cpu,
+                "temperature": soc_temperature(),
+                "throttled": is_throttled(),
+            })
+
+governor = EncodingGovernor()
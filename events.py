@@ -0,0 +1,113 @@
+# events.py
+import json
+import time
+import threading
+from collections import deque
+
+import config
+import state
+
+# Event IDs are "<boot>-<n>", so a client reconnecting after a restart is
+# recognised and gets a fresh snapshot instead of a gap.
+BOOT_ID = str(int(time.time()))
+
+class EventHub:
+    """
+    In-process broadcast of state changes for /events. Every event gets the next
+    ID and is kept in a ring of config.EVENTS_BUFFER_SIZE, so a client that
+    reconnects with Last-Event-ID is sent what it missed; a client that is too
+    far behind (or new) starts from a snapshot instead.
+    """
+
+    def __init__(self):
+        self._events = deque(maxlen=config.EVENTS_BUFFER_SIZE)  # (sequence, type, json data)
+        self._sequence = 0
+        self._condition = threading.Condition()
+
+    def publish(self, event_type, data):
+        payload = json.dumps(data)
+        with self._condition:
+            self._sequence += 1
+            self._events.append((self._sequence, event_type, payload))
+            self._condition.notify_all()
+
+    def _missed(self, last_event_id):
+        """Events after last_event_id, or None if they can't all be replayed."""
+        boot, _, sequence = (last_event_id or "").partition("-")
+        if boot != BOOT_ID or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        if sequence < self._sequence and (not self._events or self._events[0][0] > sequence + 1):
+            return None
+        return [event for event in self._events if event[0] > sequence]
+
+    def stream(self, last_event_id, snapshot):
+        """
+        Yields the text/event-stream for one client: missed events or a snapshot
+        (built by calling snapshot()), then every new event as it is published,
+        with a comment line every config.EVENTS_KEEPALIVE_SECONDS to keep proxies
+        from closing the idle connection. Ends after config.EVENTS_STREAM_MAX_SECONDS
+        so the server thread is returned; the browser reconnects with Last-Event-ID.
+        """
+        deadline = time.monotonic() + config.EVENTS_STREAM_MAX_SECONDS
+        with self._condition:
+            missed = self._missed(last_event_id)
+            sequence = self._sequence
+        if missed is None:
+            yield _format(f"{BOOT_ID}-{sequence}", "snapshot", json.dumps(snapshot()))
+        else:
+            for event in missed:
+                yield _format(f"{BOOT_ID}-{event[0]}", event[1], event[2])
+                sequence = event[0]
+
+        while time.monotonic() < deadline:
+            with self._condition:
+                self._condition.wait_for(lambda: self._sequence > sequence,
+                                         timeout=min(config.EVENTS_KEEPALIVE_SECONDS, deadline - time.monotonic()))
+                if self._events and self._events[0][0] > sequence + 1:
+                    # Fell behind the ring; start over from a snapshot.
+                    pending = None
+                else:
+                    pending = [event for event in self._events if event[0] > sequence]
+                latest = self._sequence
+            if pending is None:
+                sequence = latest
+                yield _format(f"{BOOT_ID}-{sequence}", "snapshot", json.dumps(snapshot()))
+            elif pending:
+                for event in pending:
+                    yield _format(f"{BOOT_ID}-{event[0]}", event[1], event[2])
+                    sequence = event[0]
+            else:
+                yield ": keepalive\n\n"
+
+def _format(event_id, event_type, payload):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {payload}\n\n"
+
+hub = EventHub()
+
+def upload_entry(video_path, upload):
+    """The fields of an upload shown to the UI, as in /upload_status."""
+    return {
+        'video_path': video_path,
+        'title': upload['title'],
+        'status': upload['status'],
+        'bytes_sent': upload.get('bytes_sent'),
+        'total_bytes': upload.get('total_bytes'),
+        'throughput': upload.get('throughput'),  # Bytes/s, moving average over recent chunks
+        'eta_seconds': upload.get('eta_seconds'),
+        'rate_limit': upload.get('rate_limit'),  # Bytes/s allowed by the upload throttle, None if unlimited
+    }
+
+def upload_changed(video_path):
+    """Publishes the current state.UPLOAD_STATUS entry of an upload, or its removal."""
+    upload = state.UPLOAD_STATUS.get(video_path)
+    if upload is None:
+        hub.publish("upload", {"video_path": video_path, "removed": True})
+    else:
+        hub.publish("upload", upload_entry(video_path, upload))
+
+def errors_changed():
+    hub.publish("errors", list(state.UPLOAD_ERRORS))
+
+def recording_changed(device):
+    hub.publish("recording", {"camera": device.name, "recording": device.recording, "song": device.current_song})
@@ -0,0 +1,108 @@
+# frame_thumbnail.py
+import io
+import time
+import subprocess
+from PIL import Image, ImageDraw
+
+import config
+import media_tools
+import thumbnails
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_ANALYSIS_WIDTH = 160
+_ANALYSIS_HEIGHT = 90
+
+def _score_frames(frames):
+    """
+    Scores a stack of grayscale keyframes (N x H x W, uint8); higher is better.
+    Sharpness is the variance of the Laplacian, exposure penalises frames far
+    from mid-grey or with clipped pixels, and motion is the mean difference to
+    the neighbouring samples (blurry, in-between moments score lower).
+    """
+    f = frames.astype(np.float32)
+    laplacian = (f[:, :-2, 1:-1] + f[:, 2:, 1:-1] + f[:, 1:-1, :-2] + f[:, 1:-1, 2:]
+                 - 4 * f[:, 1:-1, 1:-1])
+    sharpness = laplacian.var(axis=(1, 2))
+
+    brightness = f.mean(axis=(1, 2)) / 255
+    clipped = ((frames < 8) | (frames > 247)).mean(axis=(1, 2))
+    exposure_penalty = np.abs(brightness - 0.45) + clipped
+
+    if len(frames) > 1:
+        diffs = np.abs(np.diff(f, axis=0)).mean(axis=(1, 2))
+        motion = np.empty(len(frames), dtype=np.float32)
+        motion[0], motion[-1] = diffs[0], diffs[-1]
+        motion[1:-1] = (diffs[:-1] + diffs[1:]) / 2
+    else:
+        motion = np.zeros(1, dtype=np.float32)
+
+    sharpness_norm = sharpness / (sharpness.max() or 1)
+    motion_norm = motion / (motion.max() or 1)
+    return sharpness_norm - exposure_penalty - 0.5 * motion_norm
+
+def _composite_title(png, songname, when):
+    """Draws the song title and date on a darkened band across the frame."""
+    img = Image.open(io.BytesIO(png)).convert('RGB').resize((1280, 720))
+    band = Image.new('RGBA', (1280, 220), (0, 0, 0, 140))
+    img.paste(band, (0, 250), band)
+
+    draw = ImageDraw.Draw(img)
+    font_title = thumbnails.font(thumbnails.TITLE_FONT, 80)
+    font_date = thumbnails.font(thumbnails.DATE_FONT, 40)
+    title_w, title_h = thumbnails.text_size(draw, songname, font_title)
+    draw.text(((1280 - title_w) / 2, 360 - title_h), songname, font=font_title, fill="#FFFFFF")
+    date_text = time.strftime("%d %B at %H:%M", time.localtime(when))
+    date_w, _ = thumbnails.text_size(draw, date_text, font_date)
+    draw.text(((1280 - date_w) / 2, 380), date_text, font=font_date, fill="#FFFFFF")
+
+    out = io.BytesIO()
+    img.save(out, format="PNG", compress_level=config.THUMBNAIL_PNG_COMPRESS_LEVEL)
+    return out.getvalue()
+
+def make_frame_thumbnail(video_path, songname, when):
+    """
+    Picks the best of config.FRAME_THUMBNAIL_SAMPLES evenly spaced keyframes of a
+    take and returns it as a titled PNG, or None if no usable frame was found in
+    config.FRAME_THUMBNAIL_BUDGET_SECONDS. Each sample is one seek and one
+    keyframe decode at 160x90, so time and memory don't grow with the take length.
+    """
+    if np is None:
+        print("Frame thumbnails need numpy; using the generated splash.")
+        return None
+
+    deadline = time.monotonic() + config.FRAME_THUMBNAIL_BUDGET_SECONDS
+    duration = media_tools.probe_duration(video_path)
+    count = config.FRAME_THUMBNAIL_SAMPLES
+    # Skip the first and last 5%, which are mostly someone walking to or from the camera.
+    timestamps = [duration * (0.05 + 0.9 * (i + 0.5) / count) for i in range(count)]
+
+    frames, sampled_at = [], []
+    for timestamp in timestamps:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            raw = media_tools.grab_keyframe_gray(video_path, timestamp, _ANALYSIS_WIDTH, _ANALYSIS_HEIGHT,
+                                                 timeout=remaining)
+        except subprocess.TimeoutExpired:
+            # Out of time; pick from the frames sampled so far.
+            break
+        if raw is not None:
+            frames.append(np.frombuffer(raw, dtype=np.uint8).reshape(_ANALYSIS_HEIGHT, _ANALYSIS_WIDTH))
+            sampled_at.append(timestamp)
+    if not frames:
+        return None
+
+    scores = _score_frames(np.stack(frames))
+    best = sampled_at[int(scores.argmax())]
+    try:
+        png = media_tools.grab_keyframe_png(video_path, best, timeout=max(1.0, deadline - time.monotonic()))
+    except subprocess.TimeoutExpired:
+        png = None
+    if png is None:
+        return None
+    return _composite_title(png, songname, when)
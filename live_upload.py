@@ -0,0 +1,66 @@
+# live_upload.py
+import threading
+
+import state
+import events
+import upload_queue
+
+class LiveUpload:
+    """
+    Uploads a take to YouTube while rpicam-vid is still writing it.
+    The job sits in the upload queue as 'held' and is released to the
+    upload workers, which add it to the playlist and set the thumbnail,
+    once the recording has stopped and the thumbnail exists.
+    """
+
+    def __init__(self, video_path, thumbnail_path, title, playlist_date_str, angle=None):
+        self.video_path = video_path
+        self.thumbnail_path = thumbnail_path
+        self.title = title
+        self.playlist_date_str = playlist_date_str
+        self.angle = angle
+        self._finished = threading.Event()
+        self._aborted = threading.Event()
+        self._thumbnail_ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        upload_queue.enqueue(self.video_path, self.thumbnail_path, self.title, self.playlist_date_str,
+                             status=upload_queue.HELD, angle=self.angle)
+        state.UPLOAD_STATUS[self.video_path]['status'] = 'Streaming...'
+        events.upload_changed(self.video_path)
+        self._thread = threading.Thread(target=self._run, name="live-upload", daemon=True)
+        self._thread.start()
+
+    def finish(self):
+        """The recording has stopped; send the remaining bytes and close the session."""
+        self._finished.set()
+
+    def thumbnail_ready(self):
+        self._thumbnail_ready.set()
+
+    def abort(self):
+        """The recording failed; give up and drop the job."""
+        self._aborted.set()
+        self._finished.set()
+        self._thumbnail_ready.set()
+
+    def _run(self):
+        # Imported here so the camera code can be loaded without the Google client.
+        from youtube_uploader import upload_while_recording, RecordingAborted
+
+        try:
+            upload_while_recording(self.video_path, self.title, self._finished, self._aborted, self.angle)
+        except RecordingAborted:
+            pass
+        except Exception as e:
+            print(f"Live upload of '{self.title}' failed, the upload queue will resume it: {e}")
+            if self.video_path in state.UPLOAD_STATUS:
+                state.UPLOAD_STATUS[self.video_path]['status'] = 'Waiting...'
+                events.upload_changed(self.video_path)
+
+        self._thumbnail_ready.wait()
+        if self._aborted.is_set():
+            upload_queue.remove(self.video_path)
+        else:
+            upload_queue.release(self.video_path)
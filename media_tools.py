@@ -0,0 +1,74 @@
+# media_tools.py
+import subprocess
+
+import config
+
+def _run_ffmpeg(args):
+    """Runs ffmpeg at the lowest CPU and I/O priority so it never competes with a take being recorded."""
+    cmd = ["nice", "-n", "19", "ionice", "-c", "3", "ffmpeg", "-nostdin", "-y", "-loglevel", "error"] + args
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='ignore').strip()}")
+
+def transcode_proxy(src_path, dest_path):
+    """Makes a small, low-bitrate MP4 copy of a take for quick review on a phone."""
+    _run_ffmpeg([
+        "-i", src_path,
+        "-vf", f"scale=-2:{config.PROXY_HEIGHT}",
+        "-c:v", config.PROXY_VIDEO_CODEC, "-b:v", config.PROXY_VIDEO_BITRATE,
+        "-c:a", "aac", "-b:a", config.PROXY_AUDIO_BITRATE,
+        "-movflags", "+faststart",
+        dest_path
+    ])
+
+def probe_duration(path):
+    """Returns the duration of a media file in seconds."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=nw=1:nk=1", path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+    )
+    return float(result.stdout.decode().strip())
+
+def grab_keyframe_gray(path, timestamp, width, height, timeout=None):
+    """
+    Seeks to the keyframe at or before timestamp and returns it as 8-bit grayscale
+    bytes (width * height). Only that keyframe is decoded.
+    """
+    result = subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-skip_frame", "nokey", "-ss", f"{timestamp:.3f}",
+         "-i", path, "-frames:v", "1", "-vf", f"scale={width}:{height},format=gray",
+         "-f", "rawvideo", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout
+    )
+    return result.stdout if len(result.stdout) == width * height else None
+
+def grab_keyframe_png(path, timestamp, timeout=None):
+    """Returns the keyframe at or before timestamp, at full resolution, as PNG bytes."""
+    result = subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-skip_frame", "nokey", "-ss", f"{timestamp:.3f}",
+         "-i", path, "-frames:v", "1", "-f", "image2pipe", "-vcodec", "png", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout
+    )
+    return result.stdout or None
+
+def keyframe_times(path):
+    """Returns the timestamps of the video keyframes, read from packet flags without decoding."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags",
+         "-of", "csv=p=0", path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+    )
+    times = []
+    for line in result.stdout.decode().splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and pts not in ("", "N/A"):
+            times.append(float(pts))
+    return sorted(times)
+
+def cut_copy(src_path, dest_path, start, duration):
+    """Cuts a section out of a file by stream copy; start should be a keyframe time."""
+    _run_ffmpeg([
+        "-ss", f"{start:.3f}", "-i", src_path, "-t", f"{duration:.3f}",
+        "-map", "0", "-c", "copy", "-avoid_negative_ts", "make_zero",
+        dest_path
+    ])
@@ -0,0 +1,269 @@
+# postprocess.py
+import os
+import time
+import shutil
+import threading
+
+import config
+import store
+import media_tools
+import thumbnails
+import upload_queue
+import audio_analysis
+from frame_thumbnail import make_frame_thumbnail
+
+class Take:
+    """A finished recording on its way to the upload queue."""
+
+    def __init__(self, video_path, thumbnail_path, song, playlist_date_str, started_at, angle=None):
+        self.video_path = video_path
+        self.thumbnail_path = thumbnail_path
+        self.song = song
+        self.playlist_date_str = playlist_date_str
+        self.started_at = started_at
+        self.angle = angle  # Camera the take was recorded with, when there is more than one
+
+    @property
+    def base_path(self):
+        return self.video_path.rsplit('.', 1)[0]
+
+    @property
+    def title(self):
+        return take_title(self.song, self.angle)
+
+class SetSplit:
+    """
+    Song boundaries shared by the cameras of one set-mode session. Cameras that
+    record audio find them in their own recording; the others wait for them and
+    are cut at the same moments, so every angle is split into the same songs.
+    """
+
+    def __init__(self, audio_cameras):
+        self.audio_cameras = frozenset(audio_cameras)
+        self._searching = set(self.audio_cameras)  # Audio cameras that may still find the songs
+        self._queued = set()
+        self._boundaries = None  # (start, end) wall-clock times of each song
+        self._state = threading.Condition()
+
+    def queued(self, camera):
+        with self._state:
+            self._queued.add(camera)
+
+    def take_ended(self, camera):
+        """Called when a camera's take ends; one that never queued its recording won't find the songs."""
+        with self._state:
+            if camera not in self._queued:
+                self._searching.discard(camera)
+                self._state.notify_all()
+
+    def publish(self, camera, started_at, segments):
+        """Hands over the songs camera found, as seconds into its take started at started_at; None if it found none."""
+        with self._state:
+            self._searching.discard(camera)
+            if segments and self._boundaries is None:
+                self._boundaries = [(started_at + start, started_at + end) for start, end in segments]
+            self._state.notify_all()
+
+    def boundaries(self, started_at):
+        """
+        Waits for a camera with audio to find the songs and returns them as seconds
+        into a take started at started_at, or None once none of them could.
+        """
+        with self._state:
+            self._state.wait_for(lambda: self._boundaries is not None or not self._searching)
+            if self._boundaries is None:
+                return None
+            return [(start - started_at, end - started_at) for start, end in self._boundaries]
+
+def take_title(song, angle=None):
+    """Upload title of a take; takes from several cameras are told apart by angle."""
+    return song if angle is None else f"{song} ({angle})"
+
+def take_name(song, when, angle=None):
+    """File name (without extension) of a take; timestamped so repeated takes don't overwrite a queued upload."""
+    safe_name = "".join(c for c in take_title(song, angle) if c.isalnum() or c in (' ', '_', '-')).rstrip()
+    return f"{safe_name}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(when))}"
+
+def queue_take(take, on_done=None):
+    """
+    Queues a finished take and runs the slower post-processing stages in the
+    background. The splash thumbnail is written and the job is queued as 'held'
+    right away, so the take survives a restart; the job is released to the
+    upload workers (or on_done is called, for live uploads) when all stages are done.
+    """
+    _hold(take, on_done is None)
+    threading.Thread(target=_run_stages, args=(take, on_done), name="postprocess", daemon=True).start()
+
+def queue_set(take, split, camera):
+    """
+    Queues a set-mode recording of camera. It is held as a single upload while the
+    songs are found (see SetSplit), then split into one take per song and replaced
+    by those. If it can't be split, it is uploaded as it is.
+    """
+    split.queued(camera)
+    _hold(take, True)
+    threading.Thread(target=_split_set, args=(take, split, camera), name="postprocess-set", daemon=True).start()
+
+def _hold(take, enqueue):
+    """Writes the splash thumbnail and, unless a live upload owns the take, queues it as held."""
+    thumbnails.make_splash(take.song, take.thumbnail_path, take.started_at)
+    if enqueue:
+        proxy_video = f"{take.base_path}-proxy.mp4" if config.PROXY_UPLOAD else None
+        priority = upload_queue.PRIORITY_LOW if proxy_video else upload_queue.PRIORITY_NORMAL
+        upload_queue.enqueue(take.video_path, take.thumbnail_path, take.title, take.playlist_date_str,
+                             status=upload_queue.HELD, priority=priority, proxy_video_path=proxy_video,
+                             angle=take.angle)
+
+def _run_stages(take, on_done):
+    try:
+        if on_done is None and config.TRIM_SILENCE:
+            _trim_silence(take)
+        if config.THUMBNAIL_MODE == "frame":
+            _frame_thumbnail(take)
+        if on_done is None and config.PROXY_UPLOAD:
+            _upload_proxy(take)
+    finally:
+        if on_done is None:
+            upload_queue.release(take.video_path)
+        else:
+            on_done()
+
+def _split_set(take, split, camera):
+    """
+    Finds the songs in a set recording and cuts each out by stream copy, starting
+    at the keyframe before it. Songs are titled in setlist order; any beyond the
+    end of the setlist are numbered.
+    """
+    segment_takes = []
+    searching = camera in split.audio_cameras
+    try:
+        setlist = store.setlist()
+        if searching:
+            if audio_analysis.np is None:
+                raise RuntimeError("set mode needs numpy")
+            levels = audio_analysis.window_levels_db(take.video_path)
+            if levels.size == 0:
+                raise RuntimeError("the recording has no audio track")
+            segments = audio_analysis.music_segments(levels, count=len(setlist) or None)
+            duration = levels.size * config.AUDIO_WINDOW_SECONDS
+            split.publish(camera, take.started_at, segments)
+            searching = False
+        else:
+            # No audio of its own: cut where a camera with audio found the songs.
+            segments = split.boundaries(take.started_at)
+            if segments is None:
+                raise RuntimeError("no camera with audio found the songs")
+            duration = media_tools.probe_duration(take.video_path)
+        if not segments:
+            raise RuntimeError("no songs found")
+        if len(segments) < len(setlist):
+            print(f"Set '{take.song}': found {len(segments)} songs for a setlist of {len(setlist)}.")
+
+        keyframes = media_tools.keyframe_times(take.video_path)
+        extension = take.video_path.rsplit('.', 1)[1]
+        for number, (start, end) in enumerate(segments, 1):
+            song = setlist[number - 1] if number <= len(setlist) else f"{take.song} part {number}"
+            start = max(0.0, start - config.TRIM_PAD_SECONDS)
+            end = min(duration, end + config.TRIM_PAD_SECONDS)
+            if end <= start:
+                break  # This camera's recording ended before the song
+            start = max([t for t in keyframes if t <= start], default=0.0)
+            started_at = take.started_at + start
+            base = os.path.join(os.path.dirname(take.video_path), take_name(song, started_at, take.angle))
+            segment = Take(f"{base}.{extension}", f"{base}.png", song, take.playlist_date_str, started_at,
+                           take.angle)
+            media_tools.cut_copy(take.video_path, segment.video_path, start, end - start)
+            _hold(segment, True)
+            segment_takes.append(segment)
+            print(f"Set '{take.song}': '{song}' at {start:.0f}-{end:.0f}s.")
+    except Exception as e:
+        if searching:
+            split.publish(camera, take.started_at, None)  # Don't keep the cameras without audio waiting
+        print(f"Could not split set '{take.song}', uploading it whole: {e}")
+        for segment in segment_takes:
+            upload_queue.remove(segment.video_path)
+            for path in (segment.video_path, segment.thumbnail_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        _run_stages(take, None)
+        return
+
+    # Every song is queued (held), so the whole recording is no longer needed.
+    upload_queue.remove(take.video_path)
+    for path in (take.video_path, take.thumbnail_path):
+        if os.path.exists(path):
+            os.remove(path)
+    for segment in segment_takes:
+        _run_stages(segment, None)
+
+def _trim_silence(take):
+    """
+    Cuts the quiet head and tail off a take by stream copy, so the upload starts
+    where the music starts. The cut is made at the last keyframe before the music
+    (minus config.TRIM_PAD_SECONDS) and the trimmed file replaces the take.
+    """
+    if audio_analysis.np is None:
+        print("Silence trimming needs numpy; skipping.")
+        return
+    trimmed = f"{take.base_path}-trim.{take.video_path.rsplit('.', 1)[1]}"
+    try:
+        levels = audio_analysis.window_levels_db(take.video_path)
+        if levels.size == 0:
+            print(f"'{take.song}' has no audio track; not trimming.")
+            return
+        music = audio_analysis.np.flatnonzero(audio_analysis.music_mask(levels))
+        if music.size == 0:
+            return
+        window = config.AUDIO_WINDOW_SECONDS
+        duration = levels.size * window
+        start = max(0.0, music[0] * window - config.TRIM_PAD_SECONDS)
+        end = min(duration, (music[-1] + 1) * window + config.TRIM_PAD_SECONDS)
+        keyframes = [t for t in media_tools.keyframe_times(take.video_path) if t <= start]
+        start = keyframes[-1] if keyframes else 0.0
+        if start + (duration - end) < config.TRIM_MIN_SECONDS:
+            return
+
+        original_size = os.path.getsize(take.video_path)
+        media_tools.cut_copy(take.video_path, trimmed, start, end - start)
+        trimmed_size = os.path.getsize(trimmed)
+        if trimmed_size == 0:
+            raise RuntimeError("ffmpeg produced an empty file")
+        os.replace(trimmed, take.video_path)
+        print(f"Trimmed '{take.song}' to {start:.1f}-{end:.1f}s of {duration:.1f}s, "
+              f"saved {(original_size - trimmed_size) / 1e6:.1f} MB.")
+    except Exception as e:
+        print(f"Could not trim silence from '{take.song}': {e}")
+    finally:
+        if os.path.exists(trimmed):
+            os.remove(trimmed)
+
+def _frame_thumbnail(take):
+    """Replaces the splash with a titled frame from the take, if a good one is found."""
+    try:
+        png = make_frame_thumbnail(take.video_path, take.song, take.started_at)
+    except Exception as e:
+        print(f"Could not pick a frame thumbnail for '{take.song}': {e}")
+        return
+    if png is not None:
+        partial = take.thumbnail_path + ".part"
+        with open(partial, 'wb') as f:
+            f.write(png)
+        os.replace(partial, take.thumbnail_path)
+
+def _upload_proxy(take):
+    """
+    Transcodes a low-resolution proxy of a take and queues it ahead of the full-quality
+    video, which is held back until the proxy is queued (or failed to transcode).
+    """
+    proxy_video = f"{take.base_path}-proxy.mp4"
+    try:
+        media_tools.transcode_proxy(take.video_path, proxy_video)
+        # Each job deletes its own thumbnail after uploading, so the proxy gets a copy.
+        proxy_thumbnail = f"{take.base_path}-proxy.png"
+        shutil.copyfile(take.thumbnail_path, proxy_thumbnail)
+        upload_queue.enqueue(proxy_video, proxy_thumbnail, f"{take.title} (preview)", take.playlist_date_str,
+                             priority=upload_queue.PRIORITY_HIGH, angle=take.angle)
+    except Exception as e:
+        print(f"Could not create proxy for '{take.song}': {e}")
+        if os.path.exists(proxy_video):
+            os.remove(proxy_video)
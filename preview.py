@@ -0,0 +1,170 @@
+# preview.py
+import time
+import subprocess
+import threading
+from contextlib import contextmanager
+
+import config
+from camera_service import LatestFrame
+
+_START_RETRY_SECONDS = 5  # Wait before starting the preview again after it failed to start
+_MAX_EMPTY_WAITS = 3  # A viewer that got no frame in this many 5 s waits is sent away
+
+class PreviewProducer:
+    """
+    Single MJPEG producer for a camera that is not driven by picamera2. Runs one
+    process (rpicam-vid, or ffmpeg for a USB webcam) writing JPEG frames to stdout
+    while anyone is watching, and hands the camera back (keeping the last frame)
+    while the device is recording.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.frames = LatestFrame()
+        self._viewers = 0
+        self._lock = threading.Lock()
+        self._proc = None  # Holds device.camera_lock while set
+        self._first_sequence = 0  # frames.sequence when the current process started
+        self._thread = None
+
+    def add_viewer(self):
+        with self._lock:
+            self._viewers += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="preview-producer", daemon=True)
+                self._thread.start()
+
+    def remove_viewer(self):
+        with self._lock:
+            self._viewers -= 1
+
+    def is_active(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def owns_camera(self):
+        """True while a preview process holds the camera (and device.camera_lock), also while it starts up."""
+        return self._proc is not None
+
+    def current_frame(self, timeout):
+        """
+        The newest frame of the running preview process, waiting up to timeout for
+        its first one after a start; None if there is no preview process or no frame came.
+        """
+        with self._lock:
+            if self._proc is None:
+                return None
+            first = self._first_sequence
+        _, frame = self.frames.wait_for_frame(first, timeout=timeout)
+        return frame
+
+    def release_camera(self):
+        """Stops the preview process so the recorder can open the camera; called before a take starts."""
+        with self._lock:
+            proc, self._proc = self._proc, None
+        if proc is not None:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+            self.device.camera_lock.release()
+
+    def _start_process(self):
+        return subprocess.Popen(self.device.preview_command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def _run(self):
+        try:
+            self._produce()
+        finally:
+            # Lets the next viewer start a new producer should this one ever die.
+            with self._lock:
+                self._thread = None
+
+    def _produce(self):
+        buffer = b""
+        while True:
+            start_failed = False
+            with self._lock:
+                # busy() also covers a take that is reserved but not recording yet.
+                wanted = self._viewers > 0 and not self.device.busy()
+                proc = self._proc
+                if wanted and proc is None and self.device.camera_lock.acquire(blocking=False):
+                    try:
+                        proc = self._proc = self._start_process()
+                        self._first_sequence = self.frames.sequence
+                    except OSError as e:
+                        # E.g. the binary is missing or the webcam is unplugged; try again later.
+                        self.device.camera_lock.release()
+                        print(f"Preview of '{self.device.name}' could not start: {e}")
+                        start_failed = True
+                    buffer = b""
+            if start_failed:
+                time.sleep(_START_RETRY_SECONDS)
+                continue
+            if not wanted:
+                if proc is not None:
+                    self.release_camera()
+                time.sleep(0.2)
+                continue
+            if proc is None:
+                time.sleep(0.2)
+                continue
+
+            data = proc.stdout.read1(65536) if proc.poll() is None else b""
+            if not data:
+                # Process ended (camera taken by a recording, or an error); restart when wanted again.
+                with self._lock:
+                    if self._proc is proc:
+                        self._proc = None
+                        self.device.camera_lock.release()
+                time.sleep(0.5)
+                continue
+
+            buffer += data
+            while True:
+                start = buffer.find(b"\xff\xd8")
+                end = buffer.find(b"\xff\xd9", start + 2)
+                if start < 0 or end < 0:
+                    break
+                self.frames.write(buffer[start:end + 2])
+                buffer = buffer[end + 2:]
+            if len(buffer) > 4 * 1024 * 1024:
+                buffer = b""
+
+@contextmanager
+def viewer(device):
+    """Registers a preview viewer of a camera for as long as the block runs and yields its frame buffer."""
+    service = device.service()
+    if service is not None:
+        yield service.preview
+        return
+    device.preview.add_viewer()
+    try:
+        yield device.preview.frames
+    finally:
+        device.preview.remove_viewer()
+
+def mjpeg_stream(device):
+    """Yields multipart MJPEG parts of a camera for one client, at most config.PREVIEW_MAX_FPS frames per second."""
+    min_interval = 1.0 / config.PREVIEW_MAX_FPS
+    with viewer(device) as frames:
+        sequence = 0
+        empty_waits = 0
+        while True:
+            started = time.monotonic()
+            new_sequence, frame = frames.wait_for_frame(sequence, timeout=5.0)
+            if frame is None:
+                if frames.frame is None:
+                    # Nothing to show yet. Ending the response instead of waiting forever frees
+                    # the server thread, which otherwise only notices a gone client on a write.
+                    empty_waits += 1
+                    if empty_waits >= _MAX_EMPTY_WAITS:
+                        return
+                    continue
+                # No new frames (e.g. rpicam backend while recording): keep showing the last one.
+                frame = frames.frame
+            else:
+                sequence = new_sequence
+            yield (b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+                   + str(len(frame)).encode() + b"\r\n\r\n" + frame + b"\r\n")
+            remaining = min_interval - (time.monotonic() - started)
+            if remaining > 0:
+                time.sleep(remaining)
@@ -0,0 +1,86 @@
+# recorder_monitor.py
+import re
+import time
+import threading
+from collections import deque
+
+import config
+
+# rpicam-vid -v 2 logs one "Viewfinder frame N" line per captured frame.
+_FRAME_LINE = re.compile(r"^\s*Viewfinder frame (\d+)\b")
+
+class RecorderMonitor:
+    """
+    Reads rpicam-vid's stderr line by line while a take is running. Keeps only
+    the last few lines for error reports and derives live metrics from the
+    per-frame log lines: frame count, effective fps, dropped frames and stalls.
+    """
+
+    def __init__(self, stream, framerate):
+        self._stream = stream
+        self._framerate = framerate
+        self._tail = deque(maxlen=config.RECORDER_STDERR_TAIL_LINES)
+        self._lock = threading.Lock()
+        self._frames = 0
+        self._first_frame_at = None
+        self._last_frame_at = None
+        self._recent_frames = deque(maxlen=max(2, int(framerate * 2)))
+        self._stall_reported = False
+        self._thread = threading.Thread(target=self._run, name="recorder-monitor", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def join(self):
+        self._thread.join()
+
+    def _run(self):
+        for raw in iter(self._stream.readline, b""):
+            line = raw.decode(errors='ignore').rstrip()
+            match = _FRAME_LINE.search(line)
+            with self._lock:
+                if match:
+                    now = time.monotonic()
+                    if self._first_frame_at is None:
+                        self._first_frame_at = now
+                    self._last_frame_at = now
+                    self._frames += 1
+                    self._recent_frames.append(now)
+                    self._stall_reported = False
+                else:
+                    self._tail.append(line)
+        self._stream.close()
+
+    def tail_text(self):
+        """The last non-frame lines of stderr, for error reports."""
+        with self._lock:
+            return "\n".join(self._tail)
+
+    def metrics(self):
+        with self._lock:
+            now = time.monotonic()
+            fps = None
+            if len(self._recent_frames) > 1:
+                span = self._recent_frames[-1] - self._recent_frames[0]
+                if span > 0:
+                    fps = round((len(self._recent_frames) - 1) / span, 1)
+
+            dropped = 0
+            if self._first_frame_at is not None:
+                expected = (self._last_frame_at - self._first_frame_at) * self._framerate + 1
+                dropped = max(0, round(expected) - self._frames)
+
+            since_last = None if self._last_frame_at is None else round(now - self._last_frame_at, 1)
+            stalled = since_last is not None and since_last > config.RECORDER_STALL_SECONDS
+            if stalled and not self._stall_reported:
+                self._stall_reported = True
+                print(f"WARNING: rpicam-vid has not produced a frame for {since_last} seconds.")
+
+            return {
+                "frames": self._frames,
+                "fps": fps,
+                "dropped_frames": dropped,
+                "seconds_since_frame": since_last,
+                "stalled": stalled,
+            }
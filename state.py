@@ -1,11 +1,4 @@
 # state.py
-import threading
-
-RECORDING = False
-RECORD_PROC = None
-CURRENT_SONG = None
+RECORDING = False  # True while any camera is recording; per-camera state lives in devices.registry()
 UPLOAD_ERRORS = []
 UPLOAD_STATUS = {}
-
-snapshot_lock = threading.Lock()
-retry_lock = threading.Lock()
\ No newline at end of file
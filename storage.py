@@ -0,0 +1,129 @@
+# storage.py
+import os
+import time
+import shutil
+import threading
+
+import config
+import devices
+import upload_queue
+from encoding import governor
+
+_evict_lock = threading.Lock()
+_status_cache = {"at": 0.0, "status": None}
+
+def _bytes_per_minute(cameras=1):
+    bitrate = config.RECORD_BITRATE if config.CAMERA_BACKEND == "picamera2" else governor.expected()["bitrate"]
+    return bitrate / 8 * 60 * cameras
+
+def _committed_bytes():
+    """
+    Bytes the takes in progress are still expected to write, each taken to run
+    config.EXPECTED_TAKE_MINUTES. What they wrote so far is already off the free space.
+    """
+    now = time.time()
+    minutes = 0.0
+    for device in devices.registry().values():
+        if not device.busy():
+            continue
+        started = device.take_started  # None while the take is only reserved
+        elapsed = (now - started) / 60 if started is not None else 0.0
+        minutes += max(0.0, config.EXPECTED_TAKE_MINUTES - elapsed)
+    return minutes * _bytes_per_minute()
+
+def _usable_bytes(usage):
+    return max(0, usage.free - config.STORAGE_RESERVE_BYTES - _committed_bytes())
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def pending_bytes():
+    """Bytes on disk held by takes that are still waiting to be uploaded."""
+    return sum(_file_size(job['video_path']) + _file_size(job['thumbnail_path'])
+               for job in upload_queue.pending_jobs())
+
+def disk_status():
+    """
+    Disk headroom for /status, including how many minutes of recording still fit.
+    Computed at most every config.STORAGE_STATUS_CACHE_SECONDS, since /status and
+    every /events snapshot ask for it.
+    """
+    cached = _status_cache["status"]
+    if cached is not None and time.monotonic() - _status_cache["at"] < config.STORAGE_STATUS_CACHE_SECONDS:
+        return cached
+    status = _disk_status()
+    _status_cache.update(at=time.monotonic(), status=status)
+    return status
+
+def _invalidate_status():
+    _status_cache["status"] = None
+
+def _disk_status():
+    try:
+        usage = shutil.disk_usage(config.RECORDINGS_DIR)
+    except OSError as e:
+        # E.g. the recordings directory is gone or its drive is unmounted; /status should still answer.
+        return {"free_bytes": None, "used_fraction": None, "pending_bytes": pending_bytes(),
+                "minutes_left": None, "error": str(e)}
+    return {
+        "free_bytes": usage.free,
+        "used_fraction": round(usage.used / usage.total, 3),
+        "pending_bytes": pending_bytes(),
+        # With all cameras, after the takes in progress
+        "minutes_left": round(_usable_bytes(usage) / _bytes_per_minute(len(config.CAMERAS)), 1),
+    }
+
+def evict():
+    """
+    Once disk usage passes config.STORAGE_HIGH_WATERMARK, deletes local copies of
+    takes that are already on YouTube, oldest first, until usage is back under
+    config.STORAGE_LOW_WATERMARK. Takes that are not uploaded yet are never touched.
+    """
+    with _evict_lock:
+        try:
+            usage = shutil.disk_usage(config.RECORDINGS_DIR)
+        except OSError:
+            return 0
+        if usage.used / usage.total < config.STORAGE_HIGH_WATERMARK:
+            return 0
+
+        target_used = config.STORAGE_LOW_WATERMARK * usage.total
+        used = usage.used
+        freed = 0
+        for job in upload_queue.uploaded_jobs():
+            if used <= target_used:
+                break
+            for path in (job['video_path'], job['thumbnail_path']):
+                size = _file_size(path)
+                if size and os.path.exists(path):
+                    os.remove(path)
+                    used -= size
+                    freed += size
+        if freed:
+            _invalidate_status()
+            print(f"Storage: evicted {freed / 1e6:.0f} MB of already uploaded takes.")
+        return freed
+
+def admit_take(cameras):
+    """
+    Checks before /start whether a take of config.EXPECTED_TAKE_MINUTES on that many
+    cameras will fit next to the takes already in progress, evicting uploaded takes
+    first if needed. Returns (allowed, warning message or None).
+    """
+    os.makedirs(config.RECORDINGS_DIR, exist_ok=True)
+    evict()
+    _invalidate_status()
+    # Fresh figures: the decision to record shouldn't rest on a cached estimate.
+    try:
+        usage = shutil.disk_usage(config.RECORDINGS_DIR)
+    except OSError as e:
+        return True, f"Disk space unknown: {e}"
+    minutes_left = round(_usable_bytes(usage) / _bytes_per_minute(cameras), 1)
+    if minutes_left < config.EXPECTED_TAKE_MINUTES:
+        return False, f"Not enough disk space: about {minutes_left} minutes of recording left."
+    if minutes_left < config.STORAGE_WARN_MINUTES:
+        return True, f"Disk space is low: about {minutes_left} minutes of recording left."
+    return True, None
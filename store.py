@@ -0,0 +1,141 @@
+# store.py
+import os
+import json
+import hashlib
+import time
+import tempfile
+import threading
+
+import config
+
+DEFAULT_COLORS = {
+    "last_updated": "2000-01-01",
+    "active_index": 0,
+    "colors": ["#A7C7E7", "#C1E1C1", "#FDFD96", "#FFB347", "#FF6961"]
+}
+
+def write_json_atomic(path, data):
+    """Writes JSON to a temporary file next to path and renames it over path, so readers never see half a file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, partial = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".part", dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+class JsonFileStore:
+    """
+    A JSON file kept in memory. It is parsed (and run through process, if given)
+    once, and again only when the file's mtime, size or inode change, e.g. after
+    it was edited by hand. A missing or broken file reads as default.
+    """
+
+    def __init__(self, path, default, process=None):
+        self.path = path
+        self._default = default
+        self._process = process or (lambda data: data)
+        self._lock = threading.Lock()
+        self._signature = None
+        self._data = None
+        self._value = None
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _load(self):
+        signature = self._stat_signature()
+        if signature == self._signature and self._value is not None:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = self._default
+        self._data = data
+        self._value = self._process(data)
+        self._signature = signature
+
+    def data(self):
+        """The file's contents as parsed."""
+        with self._lock:
+            self._load()
+            return self._data
+
+    def get(self):
+        """The processed contents."""
+        with self._lock:
+            self._load()
+            return self._value
+
+    def write(self, data):
+        with self._lock:
+            write_json_atomic(self.path, data)
+            self._data = data
+            self._value = self._process(data)
+            self._signature = self._stat_signature()
+
+def _process_songs(songs):
+    songs = sorted(songs, key=lambda s: s["number"])
+    # Standardized for the client, see /songs
+    listing = [{
+        "number": song["number"],
+        "title": song["name"], # Use "name" as the source for "title"
+        "filename": f"{song['number']:02d}-{song['name'].replace(' ', '_')}.txt", # Create a filename
+        "active": song.get("active", False) # Send the active status
+    } for song in songs]
+    return {
+        "listing": listing,
+        # Changes only when the listing does, also across restarts
+        "etag": hashlib.sha1(json.dumps(listing, sort_keys=True).encode()).hexdigest()[:16],
+        "setlist": [song["name"] for song in songs if song.get("active", False)],
+    }
+
+def _process_colors(data):
+    colors = data.get("colors") or ["#000000"]
+    index = data.get("active_index", 0)
+    return {
+        "color": colors[index] if 0 <= index < len(colors) else "#000000",
+        "last_updated": data.get("last_updated"),
+    }
+
+songs = JsonFileStore(config.SONGS_PATH, [], _process_songs)
+colors = JsonFileStore(config.COLORS_PATH, DEFAULT_COLORS, _process_colors)
+
+def setlist():
+    """Names of the active songs in set order."""
+    return songs.get()["setlist"]
+
+def active_color():
+    """The background color of the day."""
+    return colors.get()["color"]
+
+def playlist_date_str():
+    """The date the color was last rolled over, which names the day's playlist."""
+    return colors.get()["last_updated"] or time.strftime("%Y-%m-%d")
+
+def roll_color_over(today_str=None):
+    """
+    Moves the active color to the next in the list when the date differs from
+    the one stored in colors.json. Returns True if it changed.
+    """
+    today_str = today_str or time.strftime("%Y-%m-%d")
+    if not os.path.exists(colors.path):
+        colors.write(DEFAULT_COLORS)
+    data = dict(colors.data())
+    if data.get("last_updated") == today_str:
+        return False
+    # Rotate to the next color, loop to the start if at the end
+    data["active_index"] = (data.get("active_index", 0) + 1) % max(1, len(data.get("colors", [])))
+    data["last_updated"] = today_str
+    colors.write(data)
+    return True
@@ -0,0 +1,95 @@
+# thumbnails.py
+import io
+import time
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from PIL import Image, ImageDraw, ImageFont
+
+import config
+import store
+
+TITLE_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+DATE_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+# Rendered PNGs keyed by (title, color, minute bucket), least recently used first.
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def font(path, size):
+    try:
+        return ImageFont.truetype(path, size)
+    except Exception:
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=8)
+def _background(color, width, height):
+    """Plain background per color; copied before drawing on it."""
+    return Image.new('RGB', (width, height), color=color)
+
+def active_color():
+    """The background color of the day, see store.active_color."""
+    return store.active_color()
+
+def _bucket(timestamp):
+    return int(timestamp // (config.THUMBNAIL_BUCKET_MINUTES * 60))
+
+def text_size(draw, text, font):
+    try:
+        bbox = draw.textbbox((0, 0), text, font=font)
+        return bbox[2] - bbox[0], bbox[3] - bbox[1]
+    except AttributeError:
+        return draw.textsize(text, font=font)
+
+def _render(songname, background_color_hex, bucket, width, height):
+    h = background_color_hex.lstrip('#')
+    r, g, b = tuple(int(h[i:i+2], 16) for i in (0, 2, 4))
+    luminance = (0.299 * r + 0.587 * g + 0.114 * b) / 255
+    text_color = "#000000" if luminance > 0.5 else "#FFFFFF"
+
+    img = _background(background_color_hex, width, height).copy()
+    draw = ImageDraw.Draw(img)
+    font_title = font(TITLE_FONT, 80)
+    font_date = font(DATE_FONT, 40)
+
+    title_w, title_h = text_size(draw, songname, font_title)
+    draw.text(((width - title_w) / 2, (height / 2) - title_h), songname, font=font_title, fill=text_color)
+
+    bucket_start = bucket * config.THUMBNAIL_BUCKET_MINUTES * 60
+    date_text = time.strftime("%d %B at %H:%M", time.localtime(bucket_start))
+    date_w, _ = text_size(draw, date_text, font_date)
+    draw.text(((width - date_w) / 2, (height / 2) + 20), date_text, font=font_date, fill=text_color)
+
+    out = io.BytesIO()
+    # Flat colors and text compress well even at the fastest zlib level.
+    img.save(out, format="PNG", compress_level=config.THUMBNAIL_PNG_COMPRESS_LEVEL)
+    return out.getvalue()
+
+def render(songname, when=None, width=1280, height=720):
+    """Returns the thumbnail PNG for a song at a time, from the cache when possible."""
+    color = active_color()
+    bucket = _bucket(when if when is not None else time.time())
+    key = (songname, color, bucket)
+    with _cache_lock:
+        png = _cache.get(key)
+        if png is not None:
+            _cache.move_to_end(key)
+            return png
+
+    png = _render(songname, color, bucket, width, height)
+    with _cache_lock:
+        _cache[key] = png
+        _cache.move_to_end(key)
+        while len(_cache) > config.THUMBNAIL_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return png
+
+def make_splash(songname, splash_path, when=None):
+    """Writes the thumbnail for a take; `when` is the take's start time."""
+    with open(splash_path, 'wb') as f:
+        f.write(render(songname, when))
+
+def prerender(songname, when=None):
+    """Renders a thumbnail in the background so the stop -> upload path finds it cached."""
+    threading.Thread(target=render, args=(songname, when), daemon=True).start()
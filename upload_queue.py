@@ -0,0 +1,315 @@
+# upload_queue.py
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import config
+import state
+import events
+
+# Job states. A job moves queued -> uploading -> done, or
+# uploading -> failed -> uploading ... until it succeeds.
+# Jobs that must wait for something else (a live upload still streaming,
+# a proxy still transcoding) start as 'held' and are released to the
+# workers (queued) when it is done.
+HELD = 'held'
+QUEUED = 'queued'
+UPLOADING = 'uploading'
+FAILED = 'failed'
+DONE = 'done'
+
+# Workers take higher priorities first, then the oldest job.
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = -10
+
+# Columns of the jobs table. New columns are appended here and added to
+# existing databases on startup by _ensure_columns().
+_COLUMNS = [
+    ("id", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    ("video_path", "TEXT NOT NULL UNIQUE"),
+    ("thumbnail_path", "TEXT NOT NULL"),
+    ("title", "TEXT NOT NULL"),
+    ("playlist_date_str", "TEXT NOT NULL"),
+    ("status", "TEXT NOT NULL"),
+    ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+    ("next_attempt_at", "REAL NOT NULL DEFAULT 0"),
+    ("last_error", "TEXT"),
+    ("created_at", "REAL NOT NULL DEFAULT 0"),
+    ("updated_at", "REAL NOT NULL DEFAULT 0"),
+    ("upload_uri", "TEXT"),
+    ("upload_offset", "INTEGER NOT NULL DEFAULT 0"),
+    ("video_id", "TEXT"),
+    ("playlist_item_id", "TEXT"),
+    ("priority", "INTEGER NOT NULL DEFAULT 0"),
+    ("proxy_video_path", "TEXT"),
+    ("angle", "TEXT"),
+    ("retire", "INTEGER NOT NULL DEFAULT 0"),  # Proxy only: 1 once it should come down, 2 once deleted
+]
+
+_db = None
+_db_lock = threading.Lock()
+_wakeup = threading.Condition()
+_workers = []
+
+def _connect():
+    """Opens the queue database once per process and prepares the schema."""
+    global _db
+    if _db is not None:
+        return _db
+
+    db = sqlite3.connect(config.UPLOAD_QUEUE_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=FULL")
+    columns = ", ".join(f"{name} {decl}" for name, decl in _COLUMNS)
+    db.execute(f"CREATE TABLE IF NOT EXISTS jobs ({columns})")
+    _ensure_columns(db)
+    _db = db
+    return _db
+
+def _ensure_columns(db):
+    """Adds columns introduced by newer versions to an existing jobs table."""
+    existing = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+    for name, decl in _COLUMNS:
+        if name not in existing:
+            decl = decl.replace(" UNIQUE", "")
+            db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {decl}")
+
+def _execute(sql, params=()):
+    with _db_lock:
+        db = _connect()
+        return db.execute(sql, params).fetchall()
+
+def enqueue(video_path, thumbnail_path, title, playlist_date_str, status=QUEUED, priority=PRIORITY_NORMAL,
+            proxy_video_path=None, angle=None):
+    """
+    Adds a take to the queue and wakes up a worker. Pass status=HELD to keep
+    the job from the workers until release() is called. proxy_video_path links
+    a full-quality job to the low-resolution proxy uploaded ahead of it. angle
+    names the camera when takes are recorded from several.
+    """
+    now = time.time()
+    _execute(
+        "INSERT OR IGNORE INTO jobs (video_path, thumbnail_path, title, playlist_date_str, status, priority, "
+        "proxy_video_path, angle, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (video_path, thumbnail_path, title, playlist_date_str, status, priority, proxy_video_path, angle, now, now)
+    )
+    state.UPLOAD_STATUS[video_path] = {'title': title, 'status': 'Waiting...'}
+    events.upload_changed(video_path)
+    with _wakeup:
+        _wakeup.notify()
+
+def release(video_path):
+    """Hands a held job over to the upload workers."""
+    _execute("UPDATE jobs SET status = ?, updated_at = ? WHERE video_path = ? AND status = ?",
+             (QUEUED, time.time(), video_path, HELD))
+    with _wakeup:
+        _wakeup.notify()
+
+def remove(video_path):
+    """Removes a job without uploading it, e.g. when its recording failed."""
+    _execute("DELETE FROM jobs WHERE video_path = ?", (video_path,))
+    state.UPLOAD_STATUS.pop(video_path, None)
+    events.upload_changed(video_path)
+
+def pending_jobs():
+    """Returns all jobs that have not been uploaded yet."""
+    return [dict(row) for row in _execute("SELECT * FROM jobs WHERE status != ? ORDER BY id", (DONE,))]
+
+def uploaded_jobs():
+    """Returns jobs already on YouTube, oldest upload first."""
+    return [dict(row) for row in _execute("SELECT * FROM jobs WHERE status = ? ORDER BY updated_at", (DONE,))]
+
+def get_job(video_path):
+    """Returns the job for a video file, or None."""
+    rows = _execute("SELECT * FROM jobs WHERE video_path = ?", (video_path,))
+    return dict(rows[0]) if rows else None
+
+def save_upload_session(video_path, upload_uri, upload_offset):
+    """Records the resumable session URI and the last byte offset YouTube confirmed."""
+    _execute("UPDATE jobs SET upload_uri = ?, upload_offset = ?, updated_at = ? WHERE video_path = ?",
+             (upload_uri, upload_offset, time.time(), video_path))
+
+def save_video_id(video_path, video_id):
+    """Records that the video itself has been uploaded, so retries skip straight to the playlist step."""
+    _execute("UPDATE jobs SET video_id = ?, upload_uri = NULL, updated_at = ? WHERE video_path = ?",
+             (video_id, time.time(), video_path))
+
+def save_playlist_item_id(video_path, playlist_item_id):
+    _execute("UPDATE jobs SET playlist_item_id = ?, updated_at = ? WHERE video_path = ?",
+             (playlist_item_id, time.time(), video_path))
+
+def _claim_next_job():
+    """
+    Atomically moves the most urgent due job to 'uploading' and returns it.
+    Returns None if nothing is due.
+    """
+    with _db_lock:
+        db = _connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) AND next_attempt_at <= ? ORDER BY priority DESC, id LIMIT 1",
+                (QUEUED, FAILED, time.time())
+            ).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                           (UPLOADING, time.time(), row["id"]))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    return dict(row) if row is not None else None
+
+def _seconds_until_next_job():
+    rows = _execute("SELECT MIN(next_attempt_at) AS due FROM jobs WHERE status IN (?, ?)", (QUEUED, FAILED))
+    due = rows[0]["due"] if rows else None
+    if due is None:
+        return None
+    return max(0.0, due - time.time())
+
+def _mark_done(job):
+    _execute("UPDATE jobs SET status = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+             (DONE, time.time(), job["id"]))
+
+def _mark_failed(job, error):
+    delay = min(config.UPLOAD_RETRY_BASE_SECONDS * 2 ** job["attempts"], config.UPLOAD_RETRY_MAX_SECONDS)
+    _execute("UPDATE jobs SET status = ?, last_error = ?, next_attempt_at = ?, updated_at = ? WHERE id = ?",
+             (FAILED, str(error), time.time() + delay, time.time(), job["id"]))
+    print(f"Upload of '{job['title']}' will be retried in {delay} seconds.")
+
+def _drop(job):
+    _execute("DELETE FROM jobs WHERE id = ?", (job["id"],))
+
+def _run_job(job):
+    # Imported here so the queue can be used without pulling in the Google client.
+    from youtube_uploader import upload_to_youtube
+
+    if not (os.path.exists(job['video_path']) and os.path.exists(job['thumbnail_path'])):
+        print(f"Files for '{job['title']}' are missing, removing from upload queue.")
+        _drop(job)
+        state.UPLOAD_STATUS.pop(job['video_path'], None)
+        events.upload_changed(job['video_path'])
+        return
+
+    state.UPLOAD_STATUS.setdefault(job['video_path'], {'title': job['title'], 'status': 'Waiting...'})
+    try:
+        upload_to_youtube(job['video_path'], job['thumbnail_path'], job['title'], job['playlist_date_str'],
+                          job['angle'])
+    except Exception as e:
+        print(f"Upload of '{job['title']}' failed: {e}")
+        # One entry per take, updated on every retry, so a take that keeps failing doesn't grow the list.
+        error = {"title": job['title'], "message": str(e), "video_path": job['video_path']}
+        for i, existing in enumerate(state.UPLOAD_ERRORS):
+            if existing.get("video_path") == job['video_path']:
+                state.UPLOAD_ERRORS[i] = error
+                break
+        else:
+            state.UPLOAD_ERRORS.append(error)
+        events.errors_changed()
+        if job['video_path'] in state.UPLOAD_STATUS:
+            state.UPLOAD_STATUS[job['video_path']]['status'] = 'Upload failed. Retrying later.'
+            events.upload_changed(job['video_path'])
+        _mark_failed(job, e)
+    else:
+        _mark_done(job)
+        if job['proxy_video_path']:
+            _retire_proxy(job)
+        elif _claim_retirement(job['video_path']):
+            # A proxy whose full-quality video finished while it was still uploading.
+            _delete_proxy_video(get_job(job['video_path']))
+        if config.KEEP_UPLOADED_FILES:
+            import storage
+            storage.evict()
+
+def _retire_proxy(job):
+    """Once a full-quality take is on YouTube, removes its proxy if config.PROXY_REPLACE is set."""
+    if not config.PROXY_REPLACE:
+        return
+    # Marked first, so a proxy that is still uploading is deleted by its own worker when it finishes.
+    _execute("UPDATE jobs SET retire = 1 WHERE video_path = ? AND retire = 0", (job['proxy_video_path'],))
+    proxy = get_job(job['proxy_video_path'])
+    if proxy is None:
+        return
+
+    if proxy['status'] == DONE:
+        if _claim_retirement(proxy['video_path']):
+            _delete_proxy_video(proxy)
+    elif proxy['status'] in (HELD, QUEUED, FAILED):
+        # The full-quality video made it first, so the proxy is no longer needed.
+        remove(proxy['video_path'])
+        for path in (proxy['video_path'], proxy['thumbnail_path']):
+            if os.path.exists(path):
+                os.remove(path)
+
+def _claim_retirement(video_path):
+    """
+    True for exactly one caller once an uploaded proxy is due to be deleted, so
+    the proxy's worker and the full-quality job's worker never both delete it.
+    """
+    with _db_lock:
+        cursor = _connect().execute("UPDATE jobs SET retire = 2 WHERE video_path = ? AND status = ? AND retire = 1",
+                                    (video_path, DONE))
+        return cursor.rowcount == 1
+
+def _delete_proxy_video(proxy):
+    if not proxy['video_id']:
+        return
+    from youtube_uploader import delete_video
+    try:
+        delete_video(proxy['video_id'])
+        print(f"Replaced proxy '{proxy['title']}' with the full-quality video.")
+    except Exception as e:
+        print(f"Could not delete proxy video {proxy['video_id']}: {e}")
+
+def _worker_loop():
+    while True:
+        job = _claim_next_job()
+        if job is None:
+            with _wakeup:
+                _wakeup.wait(timeout=_seconds_until_next_job())
+            continue
+        try:
+            _run_job(job)
+        except Exception as e:
+            # Never let a bad job take a worker down with it.
+            print(f"Upload worker error for '{job['title']}': {e}")
+            _mark_failed(job, e)
+
+def _import_failed_uploads_file():
+    """Moves entries from the legacy failed_uploads.json into the queue."""
+    try:
+        with open(config.FAILED_UPLOADS_PATH, 'r') as f:
+            failed = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return
+
+    for item in failed:
+        enqueue(item['video_path'], item['thumbnail_path'], item['title'], item['playlist_date_str'])
+    os.remove(config.FAILED_UPLOADS_PATH)
+    print(f"Imported {len(failed)} failed uploads into the upload queue.")
+
+def start_workers():
+    """
+    Recovers the queue after a restart and starts the fixed pool of upload workers.
+    Jobs that were mid-upload or held when the process died are put back in the queue.
+    """
+    if _workers:
+        return
+
+    _execute("UPDATE jobs SET status = ?, updated_at = ? WHERE status IN (?, ?)",
+             (QUEUED, time.time(), UPLOADING, HELD))
+    _import_failed_uploads_file()
+
+    for job in pending_jobs():
+        status = 'Waiting...' if job['status'] == QUEUED else 'Upload failed. Retrying later.'
+        state.UPLOAD_STATUS[job['video_path']] = {'title': job['title'], 'status': status}
+
+    for i in range(config.UPLOAD_WORKERS):
+        worker = threading.Thread(target=_worker_loop, name=f"upload-worker-{i}", daemon=True)
+        worker.start()
+        _workers.append(worker)
+    print(f"Started {config.UPLOAD_WORKERS} upload worker(s).")
@@ -0,0 +1,76 @@
+# upload_throttle.py
+import time
+import threading
+
+import config
+import state
+
+class UploadThrottle:
+    """
+    Token bucket shared by all upload workers. The refill rate depends on
+    whether a take is being recorded: config.UPLOAD_RATE_RECORDING while the
+    camera is live, then a ramp back up to config.UPLOAD_RATE_IDLE over
+    config.UPLOAD_RAMP_SECONDS once the take has stopped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last_refill = time.monotonic()
+        self._was_recording = False
+        self._recording_stopped_at = None
+
+    def current_rate(self):
+        """Returns the allowed upload rate in bytes/s, 0 for paused or None for unlimited."""
+        recording = state.RECORDING
+        now = time.monotonic()
+        if recording:
+            self._was_recording = True
+            return config.UPLOAD_RATE_RECORDING
+        if self._was_recording:
+            self._was_recording = False
+            self._recording_stopped_at = now
+
+        if self._recording_stopped_at is None:
+            return config.UPLOAD_RATE_IDLE
+        elapsed = now - self._recording_stopped_at
+        if elapsed >= config.UPLOAD_RAMP_SECONDS:
+            self._recording_stopped_at = None
+            return config.UPLOAD_RATE_IDLE
+
+        # Grow exponentially from the recording rate, 64x over the ramp window,
+        # so the uplink is back to full speed quickly without an instant burst.
+        start = max(config.UPLOAD_RATE_RECORDING, 256 * 1024)
+        rate = start * 64 ** (elapsed / config.UPLOAD_RAMP_SECONDS)
+        if config.UPLOAD_RATE_IDLE is not None:
+            rate = min(rate, config.UPLOAD_RATE_IDLE)
+        return rate
+
+    def acquire(self, num_bytes, video_path=None):
+        """Blocks until num_bytes may be sent, re-checking the recording state while waiting."""
+        while True:
+            with self._lock:
+                rate = self.current_rate()
+                if video_path in state.UPLOAD_STATUS:
+                    state.UPLOAD_STATUS[video_path]['rate_limit'] = rate
+
+                now = time.monotonic()
+                elapsed = now - self._last_refill
+                self._last_refill = now
+
+                if rate is None:
+                    self._tokens = 0.0
+                    return
+                if rate > 0:
+                    # The bucket holds at most one chunk, so an idle period can't turn into a long burst.
+                    self._tokens = min(self._tokens + elapsed * rate, float(num_bytes))
+                    if self._tokens >= 0:
+                        # Spend now and let the bucket go into debt; the next chunk waits it off.
+                        self._tokens -= num_bytes
+                        return
+                    wait = -self._tokens / rate
+                else:
+                    wait = 1.0
+            time.sleep(min(wait, 1.0))
+
+throttle = UploadThrottle()
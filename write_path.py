@@ -0,0 +1,163 @@
+# write_path.py
+import os
+import time
+import zlib
+import ctypes
+import ctypes.util
+import threading
+
+import config
+
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+_BLOCK_SIZE = 1024 * 1024
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+except (OSError, AttributeError):
+    _libc = None
+
+def _punch_hole(fd, offset, length):
+    """Frees already-spilled bytes of the tmpfs staging file so it doesn't hold the whole take in RAM."""
+    if _libc is not None and length > 0:
+        _libc.fallocate(fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, offset, length)
+
+class TakeWriter:
+    """
+    Gets a take from the recorder onto the SD card according to config.RECORD_WRITE_MODE:
+
+    "flush"    - rpicam-vid --flush, every frame is forced to disk (the old behaviour)
+    "interval" - the page cache absorbs writes and the file is fsynced every
+                 config.RECORD_FLUSH_INTERVAL seconds
+    "tmpfs"    - the recorder writes to config.RECORD_TMPFS_DIR and a background
+                 thread spills new data to the (preallocated) destination in large
+                 sequential writes every config.RECORD_FLUSH_INTERVAL seconds
+
+    Write throughput (bytes / seconds spent writing and syncing) is measured per take.
+    """
+
+    def __init__(self, dest_path, mode=None):
+        self.dest_path = dest_path
+        self.mode = mode or config.RECORD_WRITE_MODE
+        self.record_path = dest_path
+        if self.mode == "tmpfs":
+            os.makedirs(config.RECORD_TMPFS_DIR, exist_ok=True)
+            self.record_path = os.path.join(config.RECORD_TMPFS_DIR, os.path.basename(dest_path))
+        self._stop = threading.Event()
+        self._thread = None
+        self._bytes_written = 0
+        self._write_seconds = 0.0
+        self._spilled = 0
+        self._head_crcs = {}
+
+    def recorder_flags(self):
+        """Extra rpicam-vid arguments for this mode."""
+        return ["--flush"] if self.mode == "flush" else []
+
+    def start(self):
+        if self.mode == "interval":
+            self._thread = threading.Thread(target=self._flush_loop, name="take-flush", daemon=True)
+        elif self.mode == "tmpfs":
+            with open(self.dest_path, 'wb') as f:
+                if config.RECORD_PREALLOCATE_BYTES:
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, config.RECORD_PREALLOCATE_BYTES)
+                    except OSError as e:
+                        print(f"Could not preallocate {self.dest_path}: {e}")
+            self._thread = threading.Thread(target=self._spill_loop, name="take-spill", daemon=True)
+        if self._thread is not None:
+            self._thread.start()
+
+    def finish(self):
+        """Called after the recorder has exited. Makes the destination complete and durable; returns write stats."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        if self.mode == "tmpfs" and os.path.exists(self.record_path):
+            self._spill(final=True)
+            os.remove(self.record_path)
+        elif self.mode == "interval" and os.path.exists(self.dest_path):
+            self._fsync(self.dest_path)
+
+        if os.path.exists(self.dest_path):
+            self._bytes_written = os.path.getsize(self.dest_path)
+        stats = {
+            "mode": self.mode,
+            "bytes": self._bytes_written,
+            "write_seconds": round(self._write_seconds, 2),
+            "throughput": round(self._bytes_written / self._write_seconds) if self._write_seconds > 0 else None,
+        }
+        print(f"Take write stats for {self.dest_path}: {stats}")
+        return stats
+
+    def abort(self):
+        """Called when the recording failed; removes whatever was written."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for path in {self.record_path, self.dest_path}:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _fsync(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            started = time.monotonic()
+            os.fsync(fd)
+            self._write_seconds += time.monotonic() - started
+        finally:
+            os.close(fd)
+
+    def _flush_loop(self):
+        while not self._stop.wait(config.RECORD_FLUSH_INTERVAL):
+            if os.path.exists(self.dest_path):
+                self._fsync(self.dest_path)
+
+    def _spill_loop(self):
+        while not self._stop.wait(config.RECORD_FLUSH_INTERVAL):
+            if os.path.exists(self.record_path):
+                self._spill(final=False)
+
+    def _spill(self, final):
+        """
+        Copies new bytes from the staging file to the destination. Muxers only go
+        back to rewrite the start of the file (container headers), so the first
+        config.RECORD_TMPFS_KEEP_HEAD bytes stay in tmpfs and are re-copied at the
+        end wherever they changed; everything after is spilled once and freed.
+        """
+        head = config.RECORD_TMPFS_KEEP_HEAD
+        src_fd = os.open(self.record_path, os.O_RDWR)
+        dest_fd = os.open(self.dest_path, os.O_WRONLY)
+        try:
+            size = os.fstat(src_fd).st_size
+            started = time.monotonic()
+            offset = self._spilled
+            while offset < size:
+                data = os.pread(src_fd, min(_BLOCK_SIZE, size - offset), offset)
+                if not data:
+                    break
+                os.pwrite(dest_fd, data, offset)
+                if offset < head:
+                    self._head_crcs[offset] = zlib.crc32(data)
+                offset += len(data)
+
+            if final:
+                for block_offset in range(0, min(head, size), _BLOCK_SIZE):
+                    data = os.pread(src_fd, min(_BLOCK_SIZE, size - block_offset), block_offset)
+                    if self._head_crcs.get(block_offset) != zlib.crc32(data):
+                        os.pwrite(dest_fd, data, block_offset)
+                os.ftruncate(dest_fd, size)
+            os.fsync(dest_fd)
+            self._write_seconds += time.monotonic() - started
+
+            # Keep the head and the last partial block; free the rest of what was spilled.
+            free_from = max(head, self._spilled - self._spilled % _BLOCK_SIZE)
+            free_to = offset - offset % _BLOCK_SIZE
+            if not final and free_to > free_from:
+                _punch_hole(src_fd, free_from, free_to - free_from)
+            self._spilled = offset - offset % _BLOCK_SIZE if not final else offset
+        finally:
+            os.close(src_fd)
+            os.close(dest_fd)
@@ -4,156 +4,429 @@ import json
 import time
 import threading
 from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, MediaUpload
 from googleapiclient.errors import HttpError
 
 import config
 import state
+import events
+import upload_queue
+from upload_throttle import throttle
 
-retry_timer = None
+_credentials = None
+_credentials_lock = threading.Lock()
+# httplib2 connections are not thread-safe, so each upload worker gets its own client.
+_thread_local = threading.local()
 
-def upload_to_youtube(video_path, thumbnail_path, title, playlist_date_str):
+_playlist_index = None
+_playlist_lock = threading.Lock()
+
+def _token_path():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, config.TOKEN_FILE)
+
+def get_credentials():
     """
-    Uploads video and thumbnail to YouTube via the Google API.
-    Deletes local files after a successful upload.
+    Returns the process-wide OAuth credentials, loading token.json once and
+    refreshing the access token (and saving it back) when it has expired.
     """
-    print(f"Starting YouTube upload for '{title}'...")
-    if video_path in state.UPLOAD_STATUS:
-        state.UPLOAD_STATUS[video_path]['status'] = 'Uploading...'
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            token_path = _token_path()
+            if not os.path.exists(token_path):
+                print(f"ERROR: Could not find '{token_path}'.")
+                print("Run 'python authenticate.py' first to log in.")
+                raise FileNotFoundError(f"Could not find '{token_path}'. Run 'python authenticate.py' first.")
+            _credentials = Credentials.from_authorized_user_file(token_path, config.YOUTUBE_SCOPES)
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    token_path = os.path.join(script_dir, config.TOKEN_FILE)
+        if not _credentials.valid and _credentials.refresh_token:
+            print("Refreshing YouTube access token...")
+            _credentials.refresh(Request())
+            with open(_token_path(), 'w') as f:
+                f.write(_credentials.to_json())
+        return _credentials
 
-    try:
-        if not os.path.exists(token_path):
-            print(f"ERROR: Could not find '{token_path}'.")
-            print("Run 'python authenticate.py' first to log in.")
-            return
+def get_youtube_client():
+    """Returns this thread's YouTube API client, building it on first use."""
+    credentials = get_credentials()
+    youtube = getattr(_thread_local, "youtube", None)
+    if youtube is None:
+        youtube = build(config.YOUTUBE_API_SERVICE_NAME, config.YOUTUBE_API_VERSION,
+                        credentials=credentials, cache_discovery=False)
+        _thread_local.youtube = youtube
+    return youtube
 
-        credentials = Credentials.from_authorized_user_file(token_path, config.YOUTUBE_SCOPES)
-        youtube = build(config.YOUTUBE_API_SERVICE_NAME, config.YOUTUBE_API_VERSION, credentials=credentials)
+def _load_playlist_index():
+    global _playlist_index
+    if _playlist_index is None:
+        try:
+            with open(config.PLAYLIST_INDEX_PATH, 'r') as f:
+                _playlist_index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _playlist_index = {"complete": False, "playlists": {}}
+    return _playlist_index
 
-        playlist_title = f"Rehearsal {playlist_date_str}"
-        playlist_id = None
+def _save_playlist_index():
+    with open(config.PLAYLIST_INDEX_PATH, 'w') as f:
+        json.dump(_playlist_index, f, indent=2)
 
-        playlists_response = youtube.playlists().list(part="snippet", mine=True, maxResults=50).execute()
-        for item in playlists_response.get("items", []):
-            if item["snippet"]["title"] == playlist_title:
-                playlist_id = item["id"]
-                print(f"Found existing playlist: '{playlist_title}' (ID: {playlist_id})")
-                break
+def _fetch_all_playlists(youtube):
+    """Lists every playlist on the channel, following all result pages."""
+    playlists = {}
+    request = youtube.playlists().list(part="snippet", mine=True, maxResults=50)
+    while request is not None:
+        response = request.execute()
+        for item in response.get("items", []):
+            playlists.setdefault(item["snippet"]["title"], item["id"])
+        request = youtube.playlists().list_next(request, response)
+    return playlists
 
-        if not playlist_id:
-            print(f"Playlist '{playlist_title}' not found. Creating new one...")
-            playlist_body = {
-                "snippet": {"title": playlist_title, "description": f"All takes from the rehearsal on {playlist_date_str}"},
-                "status": {"privacyStatus": "private"}
-            }
-            playlist_insert_request = youtube.playlists().insert(part="snippet,status", body=playlist_body)
-            playlist_response = playlist_insert_request.execute()
-            playlist_id = playlist_response["id"]
-            print(f"Created new playlist: '{playlist_title}' (ID: {playlist_id})")
+def get_playlist_id(youtube, playlist_date_str):
+    """
+    Returns the ID of the "Rehearsal <date>" playlist, creating it if needed.
+    Lookups go through a persisted title -> ID index. The channel's playlists are
+    listed (with full pagination) only once, after that the index is kept up
+    to date as playlists are created.
+    """
+    playlist_title = f"Rehearsal {playlist_date_str}"
+    with _playlist_lock:
+        index = _load_playlist_index()
+        playlist_id = index["playlists"].get(playlist_title)
+        if playlist_id:
+            return playlist_id
 
-        body = {
-            "snippet": {
-                "title": title,
-                "description": f"Rehearsal @ {time.strftime('%Y-%m-%d %H:%M')}",
-                "tags": ["music", "live", "rehearsal"],
-                "categoryId": "10"
-            },
+        if not index["complete"]:
+            print("Building playlist index from YouTube...")
+            index["playlists"].update(_fetch_all_playlists(youtube))
+            index["complete"] = True
+            _save_playlist_index()
+            playlist_id = index["playlists"].get(playlist_title)
+            if playlist_id:
+                print(f"Found existing playlist: '{playlist_title}' (ID: {playlist_id})")
+                return playlist_id
+
+        print(f"Playlist '{playlist_title}' not found. Creating new one...")
+        playlist_body = {
+            "snippet": {"title": playlist_title, "description": f"All takes from the rehearsal on {playlist_date_str}"},
             "status": {"privacyStatus": "private"}
         }
+        playlist_response = youtube.playlists().insert(part="snippet,status", body=playlist_body).execute()
+        playlist_id = playlist_response["id"]
+        index["playlists"][playlist_title] = playlist_id
+        _save_playlist_index()
+        print(f"Created new playlist: '{playlist_title}' (ID: {playlist_id})")
+        return playlist_id
 
-        media_file = MediaFileUpload(video_path, chunksize=-1, resumable=True)
-        insert_request = youtube.videos().insert(part=",".join(body.keys()), body=body, media_body=media_file)
-        response = insert_request.execute()
-        print(f"Video uploaded. Video ID: {response['id']}")
+def _forget_playlist(playlist_title):
+    with _playlist_lock:
+        index = _load_playlist_index()
+        if index["playlists"].pop(playlist_title, None):
+            _save_playlist_index()
 
+def upload_to_youtube(video_path, thumbnail_path, title, playlist_date_str, angle=None):
+    """
+    Uploads video and thumbnail to YouTube via the Google API.
+    Deletes local files after a successful upload.
+    Raises on failure; retrying is up to the caller (see upload_queue).
+    """
+    print(f"Starting YouTube upload for '{title}'...")
+    if video_path in state.UPLOAD_STATUS:
+        state.UPLOAD_STATUS[video_path]['status'] = 'Uploading...'
+        events.upload_changed(video_path)
+
+    youtube = get_youtube_client()
+    playlist_title = f"Rehearsal {playlist_date_str}"
+    playlist_id = get_playlist_id(youtube, playlist_date_str)
+
+    job = upload_queue.get_job(video_path) or {}
+    video_id = job.get('video_id')
+    if video_id:
+        print(f"Video already uploaded earlier (ID: {video_id}), finishing remaining steps.")
+    else:
+        video_id = _upload_video_file(youtube, video_path, _video_body(title, angle), job)
+        upload_queue.save_video_id(video_path, video_id)
+        print(f"Video uploaded. Video ID: {video_id}")
+
+    if not job.get('playlist_item_id'):
         playlist_item_body = {
             "snippet": {
                 "playlistId": playlist_id,
-                "resourceId": {"kind": "youtube#video", "videoId": response['id']}
+                "resourceId": {"kind": "youtube#video", "videoId": video_id}
             }
         }
-        youtube.playlistItems().insert(part="snippet", body=playlist_item_body).execute()
-        print(f"Video added to playlist '{playlist_title}'.")
-
         try:
-            youtube.thumbnails().set(videoId=response['id'], media_body=MediaFileUpload(thumbnail_path)).execute()
-            print("Thumbnail uploaded.")
+            playlist_item = youtube.playlistItems().insert(part="snippet", body=playlist_item_body).execute()
         except HttpError as e:
-            if "custom video thumbnails" in str(e):
-                print("\n--- IMPORTANT NOTICE ---")
-                print("ERROR: Could not upload thumbnail. Your YouTube account must be verified.")
-                print("Go to https://www.youtube.com/verify to enable this feature.")
-                print("The video was uploaded, but you will need to add the thumbnail manually.")
-                print("------------------------\n")
-            else:
-                raise e
+            if e.resp.status == 404:
+                # The playlist was deleted on YouTube; the next attempt creates it again.
+                _forget_playlist(playlist_title)
+            raise
+        upload_queue.save_playlist_item_id(video_path, playlist_item["id"])
+        print(f"Video added to playlist '{playlist_title}'.")
+
+    try:
+        youtube.thumbnails().set(videoId=video_id, media_body=MediaFileUpload(thumbnail_path)).execute()
+        print("Thumbnail uploaded.")
+    except HttpError as e:
+        if "custom video thumbnails" in str(e):
+            print("\n--- IMPORTANT NOTICE ---")
+            print("ERROR: Could not upload thumbnail. Your YouTube account must be verified.")
+            print("Go to https://www.youtube.com/verify to enable this feature.")
+            print("The video was uploaded, but you will need to add the thumbnail manually.")
+            print("------------------------\n")
+        else:
+            raise e
 
+    if config.KEEP_UPLOADED_FILES:
+        # Kept until the storage manager needs the space (see storage.evict).
+        if video_path in state.UPLOAD_STATUS:
+            state.UPLOAD_STATUS[video_path]['status'] = 'Done!'
+            events.upload_changed(video_path)
+    else:
         if video_path in state.UPLOAD_STATUS:
             state.UPLOAD_STATUS[video_path]['status'] = 'Done! Deleting file...'
+            events.upload_changed(video_path)
 
         print(f"Deleting local files: {video_path}, {thumbnail_path}")
         os.remove(video_path)
         os.remove(thumbnail_path)
-        time.sleep(5)
+    # Keep "Done!" visible for a few seconds without holding up the upload worker.
+    threading.Timer(5, _clear_done_status, args=(video_path,)).start()
+
+def _clear_done_status(video_path):
+    upload = state.UPLOAD_STATUS.get(video_path)
+    if upload is not None and upload['status'].startswith('Done!'):
         state.UPLOAD_STATUS.pop(video_path, None)
+        events.upload_changed(video_path)
 
-    except Exception as e:
-        error_message = f"Upload of '{title}' failed: {e}"
-        print(error_message)
-        state.UPLOAD_ERRORS.append({"title": title, "message": str(e)})
-        if video_path in state.UPLOAD_STATUS:
-            state.UPLOAD_STATUS[video_path]['status'] = 'Upload failed. Retrying later.'
+def delete_video(video_id):
+    get_youtube_client().videos().delete(id=video_id).execute()
 
-        with state.retry_lock:
-            try:
-                with open(config.FAILED_UPLOADS_PATH, 'r') as f:
-                    failed = json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError):
-                failed = []
-
-            if not any(item['video_path'] == video_path for item in failed):
-                failed.append({
-                    "video_path": video_path, "thumbnail_path": thumbnail_path,
-                    "title": title, "playlist_date_str": playlist_date_str
-                })
-                with open(config.FAILED_UPLOADS_PATH, 'w') as f:
-                    json.dump(failed, f, indent=2)
-
-def retry_failed_uploads():
-    """Goes through failed uploads and tries to upload them again."""
-    global retry_timer
-    print("Running periodic check for failed uploads...")
-    with state.retry_lock:
-        try:
-            with open(config.FAILED_UPLOADS_PATH, 'r') as f:
-                failed = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            failed = []
+def _video_body(title, angle=None):
+    description = f"Rehearsal @ {time.strftime('%Y-%m-%d %H:%M')}"
+    tags = ["music", "live", "rehearsal"]
+    if angle:
+        description += f"\nAngle: {angle}"
+        tags.append(angle)
+    return {
+        "snippet": {
+            "title": title,
+            "description": description,
+            "tags": tags,
+            "categoryId": "10"
+        },
+        "status": {"privacyStatus": "private"}
+    }
+
+class _UploadProgress:
+    """Publishes bytes sent, a moving-average throughput and an ETA for one upload into state.UPLOAD_STATUS."""
+
+    SMOOTHING = 0.3  # Weight of the newest chunk in the moving average
+
+    def __init__(self, video_path, total_bytes, bytes_sent=0):
+        self.video_path = video_path
+        self.total_bytes = total_bytes
+        self.bytes_sent = bytes_sent
+        self.throughput = None
+        self._publish(None)
+
+    def chunk_sent(self, bytes_sent, seconds, rate_limit):
+        """Records a confirmed chunk; seconds is the time spent on the network, excluding throttle waits."""
+        if seconds > 0 and bytes_sent > self.bytes_sent:
+            rate = (bytes_sent - self.bytes_sent) / seconds
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput = self.SMOOTHING * rate + (1 - self.SMOOTHING) * self.throughput
+        self.bytes_sent = bytes_sent
+        self._publish(rate_limit)
+
+    def _publish(self, rate_limit):
+        eta = None
+        effective = self.throughput
+        if effective and rate_limit is not None:
+            effective = min(effective, rate_limit)
+        if effective:
+            eta = round((self.total_bytes - self.bytes_sent) / effective)
+        if self.video_path in state.UPLOAD_STATUS:
+            state.UPLOAD_STATUS[self.video_path].update({
+                'bytes_sent': self.bytes_sent,
+                'total_bytes': self.total_bytes,
+                'throughput': round(self.throughput) if self.throughput else None,
+                'eta_seconds': eta,
+            })
+            events.upload_changed(self.video_path)
+
+class _GovernedFileUpload(MediaFileUpload):
+    """Uses smaller chunks while a take is recording so throttled uploads send in short, even bursts."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._next_chunksize = super().chunksize()
+
+    def select_chunksize(self):
+        """Picks the size of the next chunk. Fixed per chunk, because next_chunk() reads it more than once."""
+        if state.RECORDING:
+            self._next_chunksize = config.UPLOAD_CHUNK_SIZE_RECORDING
+        else:
+            self._next_chunksize = super().chunksize()
+        return self._next_chunksize
+
+    def chunksize(self):
+        return self._next_chunksize
+
+def _upload_video_file(youtube, video_path, body, job):
+    """
+    Sends the video in chunks of config.UPLOAD_CHUNK_SIZE bytes and returns the new video ID.
+    The resumable session URI and the confirmed byte offset are saved to the upload
+    queue after every chunk, so a later attempt continues where this one stopped.
+    Each chunk waits for the upload throttle first.
+    """
+    media_file = _GovernedFileUpload(video_path, chunksize=config.UPLOAD_CHUNK_SIZE, resumable=True)
+    insert_request = youtube.videos().insert(part=",".join(body.keys()), body=body, media_body=media_file)
 
-        if not failed:
-            print("No failed uploads to retry.")
+    if job.get('upload_uri'):
+        insert_request.resumable_uri = job['upload_uri']
+        offset, response = _query_upload_offset(insert_request, media_file.size())
+        if response is not None:
+            return response['id']
+        if offset is None:
+            print("Saved upload session has expired, starting the upload again.")
+            insert_request.resumable_uri = None
+            offset = 0
         else:
-            remaining_uploads = list(failed)
-            for item in list(remaining_uploads):
-                if not (os.path.exists(item['video_path']) and os.path.exists(item['thumbnail_path'])):
-                    print(f"Files for '{item['title']}' are missing, removing from retry list.")
-                    remaining_uploads.remove(item)
-                    continue
-                try:
-                    print(f"Retrying upload for '{item['title']}'...")
-                    upload_to_youtube(item['video_path'], item['thumbnail_path'], item['title'], item['playlist_date_str'])
-                    print(f"Successfully re-uploaded '{item['title']}'.")
-                    remaining_uploads.remove(item)
-                except Exception as e:
-                    print(f"Retry for '{item['title']}' failed again: {e}")
-
-            if failed != remaining_uploads:
-                with open(config.FAILED_UPLOADS_PATH, 'w') as f:
-                    json.dump(remaining_uploads, f, indent=2)
-
-    retry_timer = threading.Timer(3600, retry_failed_uploads)
-    retry_timer.start()
\ No newline at end of file
+            print(f"Resuming upload at byte {offset} of {media_file.size()}.")
+        insert_request.resumable_progress = offset
+
+    progress = _UploadProgress(video_path, media_file.size(), insert_request.resumable_progress)
+    response = None
+    while response is None:
+        throttle.acquire(media_file.select_chunksize(), video_path)
+        started = time.monotonic()
+        _, response = insert_request.next_chunk(num_retries=config.UPLOAD_CHUNK_RETRIES)
+        sent = media_file.size() if response is not None else insert_request.resumable_progress
+        progress.chunk_sent(sent, time.monotonic() - started, throttle.current_rate())
+        if response is None:
+            upload_queue.save_upload_session(video_path, insert_request.resumable_uri, insert_request.resumable_progress)
+    return response['id']
+
+def _query_upload_offset(insert_request, total_size):
+    """
+    Asks YouTube how many bytes of a resumable session it has received.
+    Returns (offset, None) for an open session, (None, response) if the upload
+    already completed and (None, None) if the session no longer exists.
+    """
+    headers = {"Content-Range": f"bytes */{total_size}", "Content-Length": "0"}
+    resp, content = insert_request.http.request(insert_request.resumable_uri, "PUT", headers=headers)
+    if resp.status in (200, 201):
+        return None, json.loads(content)
+    if resp.status == 308:
+        if "range" in resp:
+            return int(resp["range"].split("-")[1]) + 1, None
+        return 0, None
+    if resp.status in (404, 410):
+        return None, None
+    raise HttpError(resp, content, uri=insert_request.resumable_uri)
+
+class RecordingAborted(Exception):
+    pass
+
+class _AllBytesSent(Exception):
+    """
+    The recording ended exactly at a chunk boundary: every byte went out while the
+    total was still unknown, so the session only needs to be told the size.
+    """
+
+class _GrowingFileUpload(MediaUpload):
+    """
+    Resumable media for a file that is still being written. Chunks are only
+    handed out once enough bytes exist; the total size stays unknown ('*')
+    until the recording has finished and the last, short chunk is sent.
+    """
+
+    def __init__(self, path, mimetype, chunksize, finished, aborted):
+        self._path = path
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._finished = finished
+        self._aborted = aborted
+        self._fd = open(path, 'rb')
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        if self._finished.is_set():
+            return os.path.getsize(self._path)
+        return None
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        while True:
+            if self._aborted.is_set():
+                raise RecordingAborted("Recording was aborted")
+            finished = self._finished.is_set()
+            available = os.path.getsize(self._path) - begin
+            if finished and available <= 0:
+                # next_chunk() would send an empty chunk with an invalid range.
+                raise _AllBytesSent()
+            # While recording, hold back at least one byte, so a chunk that ends
+            # exactly at the end of the file is only sent once the total is known.
+            # The total may still be missing when the recording ends during this wait;
+            # that is handled through _AllBytesSent.
+            if finished or available > length:
+                self._fd.seek(begin)
+                return self._fd.read(length)
+            self._finished.wait(0.5)
+
+    def close(self):
+        self._fd.close()
+
+def upload_while_recording(video_path, title, finished, aborted, angle=None):
+    """
+    Uploads a take that is still being recorded, following the file as it grows,
+    and finishes the resumable session with the tail once `finished` is set.
+    The session is saved after every chunk, so if this fails the upload queue
+    resumes it later like any other interrupted upload.
+    Returns the video ID.
+    """
+    youtube = get_youtube_client()
+    media = _GrowingFileUpload(video_path, config.STREAM_UPLOAD_MIMETYPE, config.UPLOAD_CHUNK_SIZE_RECORDING,
+                               finished, aborted)
+    body = _video_body(title, angle)
+    insert_request = youtube.videos().insert(part=",".join(body.keys()), body=body, media_body=media)
+    progress = _UploadProgress(video_path, os.path.getsize(video_path))
+    try:
+        response = None
+        while response is None:
+            started = time.monotonic()
+            try:
+                _, response = insert_request.next_chunk(num_retries=config.UPLOAD_CHUNK_RETRIES)
+            except _AllBytesSent:
+                offset, response = _query_upload_offset(insert_request, os.path.getsize(video_path))
+                if response is None:
+                    if offset is None:
+                        raise RuntimeError("The upload session expired before it was finished")
+                    insert_request.resumable_progress = offset
+            progress.total_bytes = os.path.getsize(video_path)
+            sent = progress.total_bytes if response is not None else insert_request.resumable_progress
+            progress.chunk_sent(sent, time.monotonic() - started, None)
+            if response is None:
+                upload_queue.save_upload_session(video_path, insert_request.resumable_uri, insert_request.resumable_progress)
+    finally:
+        media.close()
+
+    upload_queue.save_video_id(video_path, response['id'])
+    print(f"Live upload of '{title}' finished. Video ID: {response['id']}")
+    return response['id']